@@ -0,0 +1,100 @@
+"""
+Measures the grouping and rendering pipeline of commands/logic.py on synthetic expense histories, without Discord
+or PostgreSQL. Run from the repository root:
+
+    python -m benchmarks.breakdown_benchmark --rows 1000 10000 100000
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from benchmarks.fakes import FakeInteraction, InMemoryDatabase, generate_expenses
+from commands import logic
+from utils.response_cache import ResponseCache
+
+GROUPINGS = {
+    "by location": dict(levels=["location"]),
+    "by year, location": dict(group_by="yyyy", levels=["period", "location"]),
+    "by month, location": dict(group_by="mm/yy", levels=["period", "location"]),
+}
+
+
+async def measure(name, rows, func):
+    """
+    Print the throughput (rows per second) of `func` and its peak traced memory; the memory is measured by a second
+    run, as tracing allocations slows the code down several times.
+    """
+    start = time.perf_counter()
+    result = await func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    await func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:<32} {elapsed * 1000:10.1f} ms {rows / elapsed:14,.0f} rows/s {peak / 1024 / 1024:9.1f} MiB"
+          + (f"  ({result})" if result is not None else ""))
+
+
+async def walk_pages(paginator):
+    """Render every page of `paginator`, returning how many there were."""
+    pages, (content, cursor) = 1, await paginator.get_page()
+    while cursor is not None:
+        content, cursor = await paginator.get_page(cursor)
+        pages += 1
+    return f"{pages} pages"
+
+
+async def run_handlers(handler, *options):
+    for option in options:
+        await handler(FakeInteraction(), *option)
+
+
+async def benchmark(rows, locations, years):
+    expenses = generate_expenses(rows, locations=locations, years=years)
+    logic.db = InMemoryDatabase(expenses)
+    # Measure the rendering itself; the cached runs are measured separately below.
+    logic.response_cache = ResponseCache(max_entries=0)
+    print(f"{rows:,} expenses, {locations} locations, {years} years:")
+
+    async def group_keys():
+        for expense in expenses:
+            logic.get_group_key(expense.timestamp, "mm/yy")
+
+    async def format_expenses():
+        for expense in expenses:
+            logic.format_expense(expense, show_id=True)
+
+    await measure("get_group_key", rows, group_keys)
+    await measure("format_expense", rows, format_expenses)
+    for name, grouping in GROUPINGS.items():
+        # The first walk also builds the stand-in's sorted view, so only the second one is measured.
+        await walk_pages(logic.ExpensePaginator(1, "header", **grouping))
+        await measure(f"all pages {name}", rows, lambda: walk_pages(logic.ExpensePaginator(1, "header", **grouping)))
+    await measure("perform_breakdown (first pages)", rows, lambda: run_handlers(
+        logic.perform_breakdown, (None, None), (None, "yyyy"), (None, "mm/yy"), ("location 0", None)))
+    await measure("perform_total", rows, lambda: run_handlers(
+        logic.perform_total, (None, None), (None, "yyyy"), (None, "mm/yy"), ("location 0", "yyyy")))
+
+    logic.response_cache = ResponseCache()
+    await run_handlers(logic.perform_breakdown, (None, None), (None, "yyyy"), (None, "mm/yy"), ("location 0", None))
+    await run_handlers(logic.perform_total, (None, None), (None, "yyyy"), (None, "mm/yy"), ("location 0", "yyyy"))
+    await measure("perform_breakdown (cached)", rows, lambda: run_handlers(
+        logic.perform_breakdown, (None, None), (None, "yyyy"), (None, "mm/yy"), ("location 0", None)))
+    await measure("perform_total (cached)", rows, lambda: run_handlers(
+        logic.perform_total, (None, None), (None, "yyyy"), (None, "mm/yy"), ("location 0", "yyyy")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                        help="Expense history sizes to benchmark (e.g. 1000 1000000)")
+    parser.add_argument("--locations", type=int, default=50)
+    parser.add_argument("--years", type=int, default=10)
+    args = parser.parse_args()
+    for rows in args.rows:
+        asyncio.run(benchmark(rows, args.locations, args.years))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import dataclasses
+import random
+import sys
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+from db.models import Expense
+from utils.common_funcs import period_bounds
+
+CURRENCY_RATES = {"ILS": Decimal("1"), "USD": Decimal("3.7"), "EUR": Decimal("4.0"), "GBP": Decimal("4.6"),
+                  "THB": Decimal("0.1")}
+
+
+def generate_expenses(rows: int, locations: int = 50, years: int = 10, seed: int = 0):
+    """A reproducible synthetic expense history of `rows` expenses spread over `locations` and `years`."""
+    rng = random.Random(seed)
+    location_names = [sys.intern(f"location {i}") for i in range(locations)]
+    currencies = list(CURRENCY_RATES)
+    start = datetime(datetime.now().year - years + 1, 1, 1)
+    span = int(timedelta(days=365 * years).total_seconds())
+    expenses = []
+    for expense_id in range(1, rows + 1):
+        currency = rng.choice(currencies)
+        amount = Decimal(rng.randrange(100, 100_000)) / 100
+        expenses.append(Expense(expense_id, rng.choice(location_names), round(amount * CURRENCY_RATES[currency], 2),
+                                amount, currency, start + timedelta(seconds=rng.randrange(span))))
+    return expenses
+
+
+def truncate(timestamp, group_by):
+    if group_by == "yyyy":
+        return datetime(timestamp.year, 1, 1)
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+class InMemoryDatabase:
+    """
+    Stand-in for db.database.Database serving the reads of the breakdown, list and total commands from a list of
+    expenses (the same ones for every user), so their rendering can be measured without PostgreSQL.
+    Sorted views are built once per filter.
+    """
+
+    def __init__(self, expenses):
+        self.expenses = expenses
+        self.BASE_CURRENCY = "ILS"
+        self._views = {}
+
+    def _filtered(self, user_id, location=None, period=None):
+        bounds = period_bounds(period) if period else None
+        return [expense for expense in self.expenses
+                if (not location or expense.location == location.lower())
+                and (not bounds or bounds[0] <= expense.timestamp < bounds[1])]
+
+    def _sorted_view(self, user_id, location, period, group_by):
+        key = (str(user_id), location, period, group_by)
+        if key not in self._views:
+            rows = [dataclasses.replace(expense, period=truncate(expense.timestamp, group_by) if group_by else None)
+                    for expense in self._filtered(user_id, location, period)]
+            sort_key = (lambda row: (row.period, row.location, row.timestamp, row.id)) if group_by else \
+                (lambda row: (row.location, row.timestamp, row.id))
+            rows.sort(key=sort_key)
+            self._views[key] = (rows, [sort_key(row) for row in rows])
+        return self._views[key]
+
+    def get_data_version(self, user_id):
+        return 0
+
+    async def get_currency(self, user_id):
+        return self.BASE_CURRENCY
+
+    async def get_expenses_page(self, user_id, location=None, period=None, group_by=None, after=None, limit=50,
+                                search=None):
+        rows, keys = self._sorted_view(user_id, location, period, group_by)
+        if search:
+            matches = [i for i, row in enumerate(rows) if search.lower() in (row.description or "").lower()]
+            rows, keys = [rows[i] for i in matches], [keys[i] for i in matches]
+        start = bisect_right(keys, tuple(after)) if after else 0
+        return rows[start:start + limit]
+
+    async def get_group_totals(self, user_id, group_by=None, by_location=False, location=None, period=None,
+                               currency=None):
+        totals = {}
+        for expense in self._filtered(user_id, location, period):
+            group = ((truncate(expense.timestamp, group_by),) if group_by else ()) + \
+                    ((expense.location,) if by_location else ())
+            totals[group] = totals.get(group, 0) + expense.amount
+        return totals
+
+    async def get_total_spent(self, user_id, location=None, currency=None):
+        return sum(expense.amount for expense in self._filtered(user_id, location))
+
+    async def get_period_totals(self, user_id, group_by, location=None, currency=None):
+        totals = await self.get_group_totals(user_id, group_by, location=location)
+        return sorted((period, total) for (period,), total in totals.items()), sum(totals.values())
+
+    async def get_location_totals(self, user_id, period, location=None, currency=None):
+        totals = await self.get_group_totals(user_id, by_location=True, location=location, period=period)
+        return sorted((loc, total) for (loc,), total in totals.items()), sum(totals.values())
+
+
+class FakeInteraction:
+    """Just enough of discord.Interaction for the perform_* handlers; every message sent is kept in `sent`."""
+
+    def __init__(self, user_id=1):
+        self.user = SimpleNamespace(id=user_id, name=f"user{user_id}")
+        self.guild = None
+        self.sent = []
+        self.response = SimpleNamespace(send_message=self._send, defer=self._defer, is_done=lambda: bool(self.sent))
+        self.followup = SimpleNamespace(send=self._send)
+
+    async def _send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+    async def _defer(self, **kwargs):
+        pass
+
+    async def original_response(self):
+        return SimpleNamespace(edit=self._edit)
+
+    async def _edit(self, **kwargs):
+        pass
@@ -5,7 +5,11 @@ from discord import app_commands
 from discord.ext import commands
 
 from commands.logic import perform_spent, perform_total, perform_breakdown, perform_location, perform_delete, \
-    perform_list_expenses, is_allowed_user
+    perform_list_expenses, perform_rebuild_totals, perform_import, perform_export, perform_db_stats, \
+    perform_trace_stats, perform_stats, perform_burnrate, perform_chart, perform_budget, perform_budgets, \
+    perform_currency, perform_trip_create, perform_trip_join, perform_settle, autocomplete_location, \
+    autocomplete_currency, perform_search, is_allowed_user
+from utils.metrics import traced
 
 logger = logging.getLogger(__name__)
 
@@ -15,49 +19,189 @@ class BotCommands(commands.Cog):
         self.bot = bot
 
     @app_commands.command(name="spent", description="Log an expense")
-    @app_commands.describe(amount="Amount spent", currency="Currency code", description="Expense description")
+    @app_commands.describe(
+        amount="Amount spent",
+        currency="Currency code",
+        description="Expense description",
+        trip="(Optional) Share the expense with the members of a trip",
+        split_with="(Optional) Trip members (as mentions) to split the expense with, every member by default"
+    )
     @app_commands.check(is_allowed_user)
-    async def spent(self, interaction: discord.Interaction, amount: float, currency: str, description: str):
+    @traced("command.spent")
+    async def spent(self, interaction: discord.Interaction, amount: float, currency: str, description: str,
+                    trip: str = None, split_with: str = None):
         logger.info(
             f"Adding spent for {interaction.user.name}({interaction.user.id}) - Data: amount:{amount}, "
-            f"currency: {currency}, description:{description}")
-        await perform_spent(interaction, amount, currency, description)
+            f"currency: {currency}, description:{description}, trip:{trip}, split_with:{split_with}")
+        await perform_spent(interaction, amount, currency, description, trip, split_with)
+
+    @spent.autocomplete("currency")
+    async def spent_currency_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await autocomplete_currency(interaction, current)
+
+    @app_commands.command(name="import_expenses", description="Import expenses from a CSV, JSON or JSON Lines file")
+    @app_commands.describe(
+        file="File with amount, currency and description columns, and optional location and timestamp columns"
+    )
+    @app_commands.check(is_allowed_user)
+    @traced("command.import_expenses")
+    async def import_expenses(self, interaction: discord.Interaction, file: discord.Attachment):
+        logger.info(
+            f"Importing for {interaction.user.name}({interaction.user.id}) - Data: file:{file.filename}, "
+            f"size:{file.size}")
+        await perform_import(interaction, file)
 
-    @app_commands.command(name="total", description="View total spent in ILS")
+    @app_commands.command(name="export", description="Export your expenses as a compressed CSV file")
+    @app_commands.describe(
+        _filter="(Optional) filter by specific year (e.g., 2025) or month/year (e.g., 05/25)"
+    )
+    @app_commands.check(is_allowed_user)
+    @traced("command.export")
+    async def export(self, interaction: discord.Interaction, _filter: str = None):
+        logger.info(f"Exporting for {interaction.user.name}({interaction.user.id}) - Data: _filter:{_filter}")
+        await perform_export(interaction, _filter)
+
+    @app_commands.command(name="total", description="View total spent in your currency")
     @app_commands.describe(
         _location="(Optional) View total spent in a specific location",
         _group_by="(Optional) Group total by 'yyyy' or 'mm/yy', or filter by specific year (e.g., 2025) or month/year (e.g., 05/25)"
     )
     @app_commands.check(is_allowed_user)
+    @traced("command.total")
     async def total(self, interaction: discord.Interaction, _location: str = None, _group_by: str = None):
         logger.info(
             f"Performing total for {interaction.user.name}({interaction.user.id}) - Data: _location:{_location}, "
             f"_group_by: {_group_by}")
         await perform_total(interaction, _location, _group_by)
 
+    @total.autocomplete("_location")
+    async def total_location_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await autocomplete_location(interaction, current)
+
+    @app_commands.command(name="stats", description="View spending statistics in your currency")
+    @app_commands.describe(group_by="(Optional) Group by year, month (default), week, location or currency")
+    @app_commands.check(is_allowed_user)
+    @traced("command.stats")
+    async def stats(self, interaction: discord.Interaction, group_by: str = "month"):
+        logger.info(f"Performing stats for {interaction.user.name}({interaction.user.id}) - Data: group_by:{group_by}")
+        await perform_stats(interaction, group_by)
+
+    @app_commands.command(name="burnrate", description="View your daily burn rate against a budget in your currency")
+    @app_commands.describe(
+        budget="Budget in your currency for the period",
+        period="(Optional) Year (e.g., 2025) or month/year (e.g., 05/25), defaults to the current month"
+    )
+    @app_commands.check(is_allowed_user)
+    @traced("command.burnrate")
+    async def burnrate(self, interaction: discord.Interaction, budget: float, period: str = None):
+        logger.info(
+            f"Performing burnrate for {interaction.user.name}({interaction.user.id}) - Data: budget:{budget}, "
+            f"period:{period}")
+        await perform_burnrate(interaction, budget, period)
+
+    @app_commands.command(name="budget", description="Set a budget in ILS, alerting you at 50%, 80% and 100% of it")
+    @app_commands.describe(
+        amount="Budget in ILS (0 removes the budget)",
+        _location="(Optional) Only count expenses in a specific location",
+        _period="(Optional) Only count expenses in a specific year (e.g., 2025) or month/year (e.g., 05/25)"
+    )
+    @app_commands.check(is_allowed_user)
+    @traced("command.budget")
+    async def budget(self, interaction: discord.Interaction, amount: float, _location: str = None, _period: str = None):
+        logger.info(
+            f"Setting budget for {interaction.user.name}({interaction.user.id}) - Data: amount:{amount}, "
+            f"_location:{_location}, _period:{_period}")
+        await perform_budget(interaction, amount, _location, _period)
+
+    @budget.autocomplete("_location")
+    async def budget_location_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await autocomplete_location(interaction, current)
+
+    @app_commands.command(name="budgets", description="View your budgets and how much of them is spent")
+    @app_commands.check(is_allowed_user)
+    @traced("command.budgets")
+    async def budgets(self, interaction: discord.Interaction):
+        logger.info(f"Listing budgets for {interaction.user.name}({interaction.user.id})")
+        await perform_budgets(interaction)
+
+    @app_commands.command(name="chart", description="View a chart of your spending in your currency")
+    @app_commands.describe(group_by="(Optional) Chart spending per month (default) or location")
+    @app_commands.check(is_allowed_user)
+    @traced("command.chart")
+    async def chart(self, interaction: discord.Interaction, group_by: str = "month"):
+        logger.info(f"Performing chart for {interaction.user.name}({interaction.user.id}) - Data: group_by:{group_by}")
+        await perform_chart(interaction, group_by)
+
     @app_commands.command(name="breakdown", description="View expense breakdown by description")
     @app_commands.describe(
         _location="(Optional) Show breakdown for a specific location",
         _group_by="(Optional) Group breakdown by 'yyyy' or 'mm/yy', or filter by specific year (e.g., 2025) or month/year (e.g., 05/25)"
     )
     @app_commands.check(is_allowed_user)
+    @traced("command.breakdown")
     async def breakdown(self, interaction: discord.Interaction, _location: str = None, _group_by: str = None):
         logger.info(
             f"Performing breakdown for {interaction.user.name}({interaction.user.id}) - Data: _location:{_location}, "
             f"_group_by: {_group_by}")
         await perform_breakdown(interaction, _location, _group_by)
 
+    @breakdown.autocomplete("_location")
+    async def breakdown_location_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await autocomplete_location(interaction, current)
+
     @app_commands.command(name="location", description="Set your current location")
     @app_commands.describe(place="(Optional) Set current place")
     @app_commands.check(is_allowed_user)
+    @traced("command.location")
     async def location(self, interaction: discord.Interaction, place: str = None):
         logger.info(
             f"Performing location for {interaction.user.name}({interaction.user.id}) - Data: place:{place}")
         await perform_location(interaction, place)
 
+    @location.autocomplete("place")
+    async def location_place_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await autocomplete_location(interaction, current)
+
+    @app_commands.command(name="currency", description="Set the currency your reports are shown in")
+    @app_commands.describe(code="(Optional) Currency code (e.g., USD), shows the current one if omitted")
+    @app_commands.check(is_allowed_user)
+    @traced("command.currency")
+    async def currency(self, interaction: discord.Interaction, code: str = None):
+        logger.info(f"Performing currency for {interaction.user.name}({interaction.user.id}) - Data: code:{code}")
+        await perform_currency(interaction, code)
+
+    @currency.autocomplete("code")
+    async def currency_code_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await autocomplete_currency(interaction, current)
+
+    @app_commands.command(name="trip_create", description="Create a trip to share expenses with others")
+    @app_commands.describe(name="Trip name")
+    @app_commands.check(is_allowed_user)
+    @traced("command.trip_create")
+    async def trip_create(self, interaction: discord.Interaction, name: str):
+        logger.info(f"Creating trip for {interaction.user.name}({interaction.user.id}) - Data: name:{name}")
+        await perform_trip_create(interaction, name)
+
+    @app_commands.command(name="trip_join", description="Join a trip to share expenses with its members")
+    @app_commands.describe(name="Trip name")
+    @app_commands.check(is_allowed_user)
+    @traced("command.trip_join")
+    async def trip_join(self, interaction: discord.Interaction, name: str):
+        logger.info(f"Joining trip for {interaction.user.name}({interaction.user.id}) - Data: name:{name}")
+        await perform_trip_join(interaction, name)
+
+    @app_commands.command(name="settle", description="View who pays whom to settle up a trip")
+    @app_commands.describe(trip="Trip name")
+    @app_commands.check(is_allowed_user)
+    @traced("command.settle")
+    async def settle(self, interaction: discord.Interaction, trip: str):
+        logger.info(f"Settling trip for {interaction.user.name}({interaction.user.id}) - Data: trip:{trip}")
+        await perform_settle(interaction, trip)
+
     @app_commands.command(name="delete_expense", description="Delete an expense by its ID with confirmation")
     @app_commands.describe(expense_id="The ID of the expense to delete")
     @app_commands.check(is_allowed_user)
+    @traced("command.delete_expense")
     async def delete_expense(self, interaction: discord.Interaction, expense_id: str):
         logger.info(f"Deleting for {interaction.user.name}({interaction.user.id}) - Data: expense_id:{expense_id}")
         await perform_delete(interaction, expense_id)
@@ -67,11 +211,51 @@ class BotCommands(commands.Cog):
         _filter="(Optional) filter by specific year (e.g., 2025) or month/year (e.g., 05/25)"
     )
     @app_commands.check(is_allowed_user)
+    @traced("command.list_expenses")
     async def list_expenses(self, interaction: discord.Interaction, _filter: str = None):
         logger.info(
             f"Listing for {interaction.user.name}({interaction.user.id}) - Data: _filter:{_filter}")
         await perform_list_expenses(interaction, _filter)
 
+    @app_commands.command(name="search", description="Search your expenses by description")
+    @app_commands.describe(
+        query="Words to search for in expense descriptions",
+        _filter="(Optional) filter by specific year (e.g., 2025) or month/year (e.g., 05/25)",
+        _location="(Optional) Only search expenses in a specific location"
+    )
+    @app_commands.check(is_allowed_user)
+    @traced("command.search")
+    async def search(self, interaction: discord.Interaction, query: str, _filter: str = None, _location: str = None):
+        logger.info(
+            f"Searching for {interaction.user.name}({interaction.user.id}) - Data: query:{query}, _filter:{_filter}, "
+            f"_location:{_location}")
+        await perform_search(interaction, query, _filter, _location)
+
+    @search.autocomplete("_location")
+    async def search_location_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await autocomplete_location(interaction, current)
+
+    @app_commands.command(name="rebuild_totals", description="Recalculate your stored totals from your expenses")
+    @app_commands.check(is_allowed_user)
+    @traced("command.rebuild_totals")
+    async def rebuild_totals(self, interaction: discord.Interaction):
+        logger.info(f"Rebuilding totals for {interaction.user.name}({interaction.user.id})")
+        await perform_rebuild_totals(interaction)
+
+    @app_commands.command(name="db_stats", description="Show database pool usage and query latencies")
+    @app_commands.check(is_allowed_user)
+    @traced("command.db_stats")
+    async def db_stats(self, interaction: discord.Interaction):
+        logger.info(f"Showing db stats for {interaction.user.name}({interaction.user.id})")
+        await perform_db_stats(interaction)
+
+    @app_commands.command(name="trace_stats", description="Show the latency of commands and db calls")
+    @app_commands.check(is_allowed_user)
+    @traced("command.trace_stats")
+    async def trace_stats(self, interaction: discord.Interaction):
+        logger.info(f"Showing trace stats for {interaction.user.name}({interaction.user.id})")
+        await perform_trace_stats(interaction)
+
 
 async def setup(bot):
     await bot.add_cog(BotCommands(bot))
@@ -1,16 +1,42 @@
+import asyncio
+import csv
+import io
 import logging
 import re
-from collections import defaultdict
+import tempfile
 
+import asyncpg
 import discord
+from discord import app_commands
 
 from db.database import db
+from db.expense_writer import TRANSIENT_ERRORS, expense_writer
 from utils import config
-from utils.common_funcs import format_time
+from utils.common_funcs import format_time, period_bounds, utc_now
+from utils.expense_charts import CHART_GROUPINGS, render_chart
+from utils.expense_export import export_expenses_csv
+from utils.expense_import import iter_import_rows
+from utils.expense_stats import STATS_GROUPINGS, to_epoch_day
+from utils.metrics import traces
+from utils.response_cache import response_cache
+from utils.trip_ledger import settle_up
 from views.ConfirmationView import ConfirmationView
+from views.PaginationView import PaginationView
 
 logger = logging.getLogger(__name__)
 
+# Discord rejects messages longer than MESSAGE_LIMIT characters; CLOSING_RESERVE leaves room for the trailing
+# subtotal/grand total lines, and PAGE_ROWS caps how many expenses are fetched per page.
+MESSAGE_LIMIT = 2000
+CLOSING_RESERVE = 100
+# Descriptions (and search queries) are shown up to DESCRIPTION_LIMIT characters, so a single expense always fits a page.
+DESCRIPTION_LIMIT = 200
+PAGE_ROWS = 40
+# Attachment size limit outside of a guild (guilds report their own limit).
+DEFAULT_FILE_SIZE_LIMIT = 10 * 1024 * 1024
+# Seconds before retrying budget alerts that couldn't be delivered.
+BUDGET_ALERT_RETRY_DELAY = 60
+
 
 ##### General #####
 def is_allowed_user(interaction: discord.Interaction) -> bool:
@@ -20,102 +46,420 @@ def is_allowed_user(interaction: discord.Interaction) -> bool:
     return is_allowed
 
 
+async def get_cached_response(user_id, key, render):
+    """
+    The response cached for the user under `key`, or the result of awaiting `render()`, which is then cached until the
+    user's data changes (or the entry expires or is evicted).
+    """
+    version = db.get_data_version(user_id)
+    cache_key = (str(user_id),) + key
+    response = response_cache.get(cache_key, version)
+    if response is None:
+        response = await render()
+        response_cache.put(cache_key, version, response)
+    return response
+
+
+##### Autocomplete #####
+# Discord shows at most 25 suggestions, and autocomplete has to answer before its short deadline, so both are served
+# from in-memory prefix indexes rather than the database.
+async def autocomplete_location(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    return [app_commands.Choice(name=location, value=location)
+            for location in db.search_locations(interaction.user.id, current.strip())]
+
+
+async def autocomplete_currency(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    return [app_commands.Choice(name=code, value=code) for code in db.search_currencies(current.strip())]
+
+
 ##### Spent #####
-async def perform_spent(interaction: discord.Interaction, amount: float, currency: str, description: str):
-    success = await db.add_expense(interaction.user.id, amount, currency.upper(), description)
-    if success is None:
+async def perform_spent(interaction: discord.Interaction, amount: float, currency: str, description: str,
+                        trip: str = None, split_with: str = None):
+    if trip:
+        await perform_trip_spent(interaction, amount, currency, description, trip, split_with)
+        return
+
+    if config.SPENT_WRITE_BEHIND:
+        try:
+            queued = await expense_writer.submit(interaction.user.id, amount, currency.upper(), description,
+                                                 notify=lambda message: interaction.followup.send(message, ephemeral=True))
+        except asyncio.QueueFull:
+            # The queue is full or shutting down, so write the expense directly.
+            expense_id = await db.add_expense(interaction.user.id, amount, currency.upper(), description)
+        else:
+            if queued:
+                await interaction.response.send_message(
+                    f"✅ Recorded expense: {amount} {currency.upper()} for {description} (converted to ILS).")
+                return
+            expense_id = queued
+    else:
+        expense_id = await db.add_expense(interaction.user.id, amount, currency.upper(), description)
+    if expense_id is None:
         await interaction.response.send_message("⚠️ Please set your location first using `/location <location>`.",
                                                 ephemeral=True)
-    elif success is False:
+    elif expense_id is False:
         await interaction.response.send_message("⚠️ Invalid currency. Use a supported currency code.",
                                                 ephemeral=True)
     else:
         await interaction.response.send_message(
-            f"✅ Recorded: {amount} {currency.upper()} for {description} (converted to ILS).")
+            f"✅ Recorded expense #{expense_id}: {amount} {currency.upper()} for {description} (converted to ILS).")
 
 
-##### Total #####
-async def perform_total(interaction: discord.Interaction, _location: str = None, _group_by: str = None):
-    # If no grouping/filter option is provided, use the existing total.
-    if not _group_by:
-        total_spent = await db.get_total_spent(interaction.user.id, _location.lower() if _location else None)
-        if _location:
-            await interaction.response.send_message(
-                f"💰 You have spent a total of {total_spent:.2f} ILS in {_location}."
-            )
-        else:
-            await interaction.response.send_message(f"💰 You have spent a total of {total_spent:.2f} ILS overall.")
+async def perform_trip_spent(interaction: discord.Interaction, amount: float, currency: str, description: str,
+                             trip: str, split_with: str = None):
+    trip_row = await db.get_trip(interaction.user.id, trip)
+    if trip_row is None:
+        await interaction.response.send_message(f"❌ You are not a member of a trip named '{trip}'.", ephemeral=True)
         return
 
+    # Split between the payer and the mentioned members, or every member if split_with is omitted.
+    mentioned = re.findall(r"\d{15,}", split_with or "")
+    if split_with and split_with.strip() and not mentioned:
+        await interaction.response.send_message(
+            "❌ Mention the members to split with (e.g., @alice @bob), or leave split_with empty to split with everyone.",
+            ephemeral=True
+        )
+        return
+    members = await db.get_trip_balances(trip_row["id"])
+    participants = list(dict.fromkeys([str(interaction.user.id)] + mentioned)) if mentioned else sorted(members)
+    not_members = [user_id for user_id in participants if user_id not in members]
+    if not_members:
+        await interaction.response.send_message(
+            f"❌ {', '.join(f'<@{user_id}>' for user_id in not_members)} didn't join {trip_row['name']}.", ephemeral=True
+        )
+        return
+
+    expense_id = await db.add_trip_expense(interaction.user.id, trip_row["id"], amount, currency.upper(), description,
+                                           participants)
+    if expense_id is None:
+        await interaction.response.send_message("⚠️ Please set your location first using `/location <location>`.",
+                                                ephemeral=True)
+    elif expense_id is False:
+        await interaction.response.send_message("⚠️ Invalid currency. Use a supported currency code.",
+                                                ephemeral=True)
+    else:
+        await interaction.response.send_message(
+            f"✅ Recorded expense #{expense_id}: {amount} {currency.upper()} for {description} in {trip_row['name']}, "
+            f"split between {len(participants)} members (converted to ILS).")
+
+
+##### Trips #####
+async def perform_trip_create(interaction: discord.Interaction, name: str):
+    trip_id = await db.create_trip(interaction.user.id, name.strip())
+    if trip_id is None:
+        await interaction.response.send_message(f"❌ A trip named '{name}' already exists.", ephemeral=True)
+        return
+    await interaction.response.send_message(
+        f"🧳 Created trip {name}. Others can join with `/trip_join {name}`, and expenses are shared with "
+        f"`/spent ... trip:{name}`."
+    )
+
+
+async def perform_trip_join(interaction: discord.Interaction, name: str):
+    trip = await db.join_trip(interaction.user.id, name)
+    if trip is None:
+        await interaction.response.send_message(f"❌ There is no trip named '{name}'.", ephemeral=True)
+        return
+    await interaction.response.send_message(f"🧳 You joined {trip['name']}.")
+
+
+async def perform_settle(interaction: discord.Interaction, trip: str):
+    trip_row = await db.get_trip(interaction.user.id, trip)
+    if trip_row is None:
+        await interaction.response.send_message(f"❌ You are not a member of a trip named '{trip}'.", ephemeral=True)
+        return
+
+    balances = await db.get_trip_balances(trip_row["id"])
+    transfers = settle_up(balances)
+    if not transfers:
+        await interaction.response.send_message(f"🤝 Everyone in {trip_row['name']} is settled up.")
+        return
+
+    content = f"🤝 **Settle up {trip_row['name']}:**"
+    for debtor, creditor, amount in transfers:
+        line = f"<@{debtor}> pays <@{creditor}> {amount:.2f} ILS"
+        if len(content) + len(line) + 1 > MESSAGE_LIMIT:
+            break
+        content += "\n" + line
+    await interaction.response.send_message(content, allowed_mentions=discord.AllowedMentions.none())
+
+
+##### Import #####
+async def perform_import(interaction: discord.Interaction, file: discord.Attachment):
+    # Parsing, rate lookups and COPY can take longer than Discord's 3 second response window.
+    await interaction.response.defer(thinking=True)
+    try:
+        data = await file.read()
+        imported = await db.import_expenses(interaction.user.id, iter_import_rows(file.filename, data))
+    except (ValueError, csv.Error) as e:
+        await interaction.followup.send(f"❌ Import failed, no expenses were saved. {e}")
+        return
+    except TRANSIENT_ERRORS + (asyncpg.PostgresError, KeyError) as e:
+        logger.error(f"Failed to import {file.filename} for {interaction.user.id}: {e!r}")
+        await interaction.followup.send("❌ Import failed, no expenses were saved. Exchange rates or the database are "
+                                        "unavailable right now, please try again later.")
+        return
+    await interaction.followup.send(f"✅ Imported {imported} expenses from {file.filename} (converted to ILS).")
+
+
+##### Export #####
+async def perform_export(interaction: discord.Interaction, _filter: str = None):
+    if _filter and period_bounds(_filter) is None:
+        await interaction.response.send_message(
+            "❌ Invalid filter. Use a 4-digit year (e.g., 2025) or month/year (e.g., 05/25).", ephemeral=True
+        )
+        return
+
+    await interaction.response.defer(thinking=True, ephemeral=True)
+    with tempfile.TemporaryFile() as export_file:
+        exported = await export_expenses_csv(db.iter_expense_batches(interaction.user.id, period=_filter), export_file)
+        if not exported:
+            message = f"📦 No expenses match the filter '{_filter}'." if _filter else "📦 No expenses recorded yet."
+            await interaction.followup.send(message, ephemeral=True)
+            return
+
+        size_limit = interaction.guild.filesize_limit if interaction.guild else DEFAULT_FILE_SIZE_LIMIT
+        if export_file.tell() > size_limit:
+            await interaction.followup.send(
+                "❌ The export is too large to upload. Try a specific year (e.g., 2025) or month/year (e.g., 05/25).",
+                ephemeral=True
+            )
+            return
+
+        export_file.seek(0)
+        filename = f"expenses-{_filter.replace('/', '-')}.csv.gz" if _filter else "expenses.csv.gz"
+        await interaction.followup.send(f"📦 Exported {exported} expenses.", file=discord.File(export_file, filename),
+                                        ephemeral=True)
+
+
+##### Total #####
+async def perform_total(interaction: discord.Interaction, _location: str = None, _group_by: str = None):
     # Validate _group_by option.
     valid_literals = {"yyyy", "mm/yy"}
-    if _group_by not in valid_literals and not (
-            re.match(r"^\d{4}$", _group_by) or re.match(r"^\d{2}/\d{2}$", _group_by)
-    ):
+    if _group_by and _group_by not in valid_literals and period_bounds(_group_by) is None:
         await interaction.response.send_message(
             "❌ Invalid grouping option. Use 'yyyy' or 'mm/yy', or pass a valid year (e.g., 2025) or month/year (e.g., 05/25)."
         )
         return
 
-    # Retrieve all expenses via breakdown.
-    _breakdown = await db.get_breakdown(interaction.user.id, _location.lower() if _location else None)
-    if not _breakdown:
-        message = f"💰 No expenses recorded for **{_location}**." if _location else "💰 No expenses recorded yet."
-        await interaction.response.send_message(message)
-        return
+    response = await get_cached_response(interaction.user.id, ("total", _location, _group_by),
+                                         lambda: render_total(interaction.user.id, _location, _group_by))
+    await interaction.response.send_message(response)
+
+
+async def render_total(user_id, _location: str = None, _group_by: str = None) -> str:
+    currency = await db.get_currency(user_id)
+    # If no grouping/filter option is provided, use the existing total.
+    if not _group_by:
+        total_spent = await db.get_total_spent(user_id, _location.lower() if _location else None, currency)
+        if _location:
+            return f"💰 You have spent a total of {total_spent:.2f} {currency} in {_location}."
+        return f"💰 You have spent a total of {total_spent:.2f} {currency} overall."
 
     # Two scenarios:
-    # 1. _group_by is a literal grouping option ("yyyy" or "mm/yy")
-    # 2. _group_by is a specific filter (e.g., "2025" or "05/25")
-    if _group_by in valid_literals:
-        # Use your group_expenses helper to group all expenses accordingly.
-        grouped_expenses = group_expenses(_breakdown, _group_by, _location)
+    # 1. _group_by is a literal grouping option ("yyyy" or "mm/yy") - totals per year or month/year.
+    # 2. _group_by is a specific filter (e.g., "2025" or "05/25") - totals per location within that period.
+    # Both are aggregated by the database, which also returns the grand total.
+    if _group_by in {"yyyy", "mm/yy"}:
+        period_totals, grand_total = await db.get_period_totals(user_id, _group_by,
+                                                                _location.lower() if _location else None, currency)
+        if not period_totals:
+            return f"💰 No expenses recorded for **{_location}**." if _location else "💰 No expenses recorded yet."
+
         response = f"💰 **Total Spent Breakdown{' for ' + _location if _location else ''}:**\n"
-        grand_total = 0
+        for period, group_total in period_totals:
+            response += f"**{get_group_key(period, _group_by)}:** {group_total:.2f} {currency}\n"
+        response += f"\n**Grand Total:** {grand_total:.2f} {currency}"
+        return response
 
-        if not grouped_expenses:
-            await interaction.response.send_message(f"💰 No expenses match the filter '{_group_by}'.")
-            return
+    location_totals, grand_total = await db.get_location_totals(user_id, _group_by,
+                                                                _location.lower() if _location else None, currency)
+    if not location_totals:
+        return f"💰 No expenses match the filter '{_group_by}'."
+
+    response = f"💰 **Total Spent Breakdown{' for ' + _location if _location else ''}:**\n"
+    response += f"**{_group_by}:**\n"
+    for loc, group_total in location_totals:
+        response += f"**{loc}:** {group_total:.2f} {currency}\n"
+    response += f"\n**Grand Total:** {grand_total:.2f} {currency}"
+    return response
 
-        # For each group (e.g., each year or month/year)
-        for key, expenses in grouped_expenses.items():
-            group_total = sum(exp["amount"] for exp in expenses)
-            response += f"**{key}:** {group_total:.2f} ILS\n"
-            grand_total += group_total
-        response += f"\n**Grand Total:** {grand_total:.2f} ILS"
-        await interaction.response.send_message(response)
+
+##### Stats #####
+async def perform_stats(interaction: discord.Interaction, group_by: str = "month"):
+    if group_by not in STATS_GROUPINGS:
+        await interaction.response.send_message(f"❌ Invalid grouping. Use one of: {', '.join(STATS_GROUPINGS)}.",
+                                                ephemeral=True)
+        return
+
+    currency = await db.get_currency(interaction.user.id)
+    stats = await db.get_expense_stats(interaction.user.id, currency)
+    if not len(stats):
+        await interaction.response.send_message("📈 No expenses recorded yet.")
+        return
+
+    today = to_epoch_day(utc_now().date())
+    header = [
+        "📈 **Spending Stats:**",
+        f"Total: {stats.total:.2f} {currency} over {stats.count} expenses "
+        f"(avg {stats.total / stats.count:.2f} {currency})",
+        f"Daily average: {stats.running_average(7, today):.2f} {currency} (7 days), "
+        f"{stats.running_average(30, today):.2f} {currency} (30 days), "
+        f"{stats.running_average(365, today):.2f} {currency} (365 days)",
+        "",
+        f"**By {group_by}:**",
+    ]
+    groups = stats.group_totals(group_by)
+    if group_by in ("location", "currency"):
+        groups.sort(key=lambda group: group[1], reverse=True)
+    else:
+        # Chronological groups: keep the most recent ones if they don't all fit.
+        groups.reverse()
+
+    lines = []
+    length = sum(len(line) + 1 for line in header)
+    for label, total, count, original_total in groups:
+        line = f"**{label}:** {total:.2f} {currency} ({count} expenses"
+        line += f", {original_total:.2f} {label})" if group_by == "currency" else ")"
+        if length + len(line) + 1 > MESSAGE_LIMIT:
+            break
+        lines.append(line)
+        length += len(line) + 1
+    if group_by not in ("location", "currency"):
+        lines.reverse()
+    await interaction.response.send_message("\n".join(header + lines))
+
+
+async def perform_burnrate(interaction: discord.Interaction, budget: float, period: str = None):
+    period = period or utc_now().date().strftime("%m/%y")
+    if period_bounds(period) is None:
+        await interaction.response.send_message(
+            "❌ Invalid period. Use a 4-digit year (e.g., 2025) or month/year (e.g., 05/25).", ephemeral=True
+        )
+        return
+    if budget <= 0:
+        await interaction.response.send_message("❌ The budget must be positive.", ephemeral=True)
+        return
+
+    currency = await db.get_currency(interaction.user.id)
+    stats = await db.get_expense_stats(interaction.user.id, currency)
+    burn = stats.burn_rate(budget, period, utc_now().date())
+    response = (
+        f"🔥 **Burn rate for {period}:**\n"
+        f"Spent {burn['spent']:.2f} of {budget:.2f} {currency} ({burn['spent'] / budget:.0%}) "
+        f"in {burn['days_elapsed']} days\n"
+        f"Daily burn rate: {burn['daily_rate']:.2f} {currency}, projected total: {burn['projected']:.2f} {currency}\n"
+    )
+    if burn["remaining"] > 0 and burn["days_left"]:
+        response += (f"Remaining: {burn['remaining']:.2f} {currency}, {burn['daily_allowance']:.2f} {currency}/day "
+                     f"for {burn['days_left']} days\n")
+    if burn["exhausted_on"]:
+        verb = "ran out" if burn["remaining"] <= 0 else "will run out"
+        response += f"⚠️ The budget {verb} on {burn['exhausted_on'].strftime('%d/%m/%Y')}"
     else:
-        # _group_by is a specific filter (e.g., "2025" or "05/25")
-        # Filter expenses by the specified literal, then group by location.
-        filtered_breakdown = {}
-        for loc, expenses in _breakdown.items():
-            if _location and loc.lower() != _location.lower():
-                continue
-            filtered = []
-            for expense in expenses:
-                dt = expense["timestamp"]
-                if re.match(r"^\d{4}$", _group_by):  # specific year filter
-                    if dt.strftime("%Y") == _group_by:
-                        filtered.append(expense)
-                elif re.match(r"^\d{2}/\d{2}$", _group_by):  # specific month/year filter
-                    if dt.strftime("%m/%y") == _group_by:
-                        filtered.append(expense)
-            if filtered:
-                filtered_breakdown[loc] = filtered
-
-        if not filtered_breakdown:
-            await interaction.response.send_message(f"💰 No expenses match the filter '{_group_by}'.")
+        response += "✅ On track to stay within the budget"
+    await interaction.response.send_message(response)
+
+
+##### Chart #####
+async def perform_chart(interaction: discord.Interaction, group_by: str = "month"):
+    if group_by not in CHART_GROUPINGS:
+        await interaction.response.send_message(f"❌ Invalid grouping. Use one of: {', '.join(CHART_GROUPINGS)}.",
+                                                ephemeral=True)
+        return
+
+    # The version is read before the expenses, so a chart of data that changes meanwhile is never cached as current.
+    version = db.get_data_version(interaction.user.id)
+    chart = db.chart_cache.get(interaction.user.id, group_by, version)
+    if chart is None:
+        currency = await db.get_currency(interaction.user.id)
+        stats = await db.get_expense_stats(interaction.user.id, currency)
+        if not len(stats):
+            await interaction.response.send_message("📉 No expenses recorded yet.")
             return
+        # Rendering takes long enough to stall the event loop, so it runs in a worker thread.
+        await interaction.response.defer(thinking=True)
+        chart = await asyncio.to_thread(render_chart, stats, group_by, currency)
+        db.chart_cache.put(interaction.user.id, group_by, version, chart)
+        await interaction.followup.send(file=discord.File(io.BytesIO(chart), f"spending-per-{group_by}.png"))
+        return
+    await interaction.response.send_message(file=discord.File(io.BytesIO(chart), f"spending-per-{group_by}.png"))
+
+
+##### Budget #####
+def describe_budget(budget):
+    scope = f" in {budget['location_key']}" if budget["location_key"] else ""
+    scope += f" for {budget['period']}" if budget["period"] else ""
+    return f"budget{scope}"
+
+
+async def perform_budget(interaction: discord.Interaction, amount: float, _location: str = None, _period: str = None):
+    if _period and period_bounds(_period) is None:
+        await interaction.response.send_message(
+            "❌ Invalid period. Use a 4-digit year (e.g., 2025) or month/year (e.g., 05/25).", ephemeral=True
+        )
+        return
+    amount = round(amount, 2)
+    if amount < 0:
+        await interaction.response.send_message("❌ The budget can't be negative.", ephemeral=True)
+        return
+
+    location = _location.lower() if _location else None
+    if amount == 0:
+        deleted = await db.delete_budget(interaction.user.id, location, _period)
+        budget = describe_budget({"location_key": location, "period": _period})
+        await interaction.response.send_message(f"🗑️ Removed your {budget}." if deleted else f"❌ You have no {budget}.",
+                                                ephemeral=True)
+        return
+
+    budget = await db.set_budget(interaction.user.id, amount, location, _period)
+    await interaction.response.send_message(
+        f"🎯 Set your {describe_budget(budget)} to {budget['amount']:.2f} ILS, "
+        f"{budget['spent']:.2f} ILS ({budget['spent'] / budget['amount']:.0%}) spent so far."
+    )
 
-        response = f"💰 **Total Spent Breakdown{' for ' + _location if _location else ''}:**\n"
-        response += f"**{_group_by}:**\n"
-        grand_total = 0
-        for loc, expenses in filtered_breakdown.items():
-            group_total = sum(exp["amount"] for exp in expenses)
-            response += f"**{loc}:** {group_total:.2f} ILS\n"
-            grand_total += group_total
-        response += f"\n**Grand Total:** {grand_total:.2f} ILS"
-        await interaction.response.send_message(response)
+
+async def perform_budgets(interaction: discord.Interaction):
+    budgets = await db.get_budgets(interaction.user.id)
+    if not budgets:
+        await interaction.response.send_message("🎯 No budgets set yet. Use `/budget <amount>` to set one.")
+        return
+
+    content = "🎯 **Budgets:**"
+    for budget in budgets:
+        line = (f"**{describe_budget(budget).capitalize()}:** {budget['spent']:.2f} of {budget['amount']:.2f} ILS "
+                f"({budget['spent'] / budget['amount']:.0%}), {budget['amount'] - budget['spent']:.2f} ILS left")
+        if len(content) + len(line) + 1 > MESSAGE_LIMIT:
+            break
+        content += "\n" + line
+    await interaction.response.send_message(content)
+
+
+async def deliver_budget_alerts(bot):
+    """
+    Check the budgets of every user whose expenses changed, and DM them each alert threshold their spend reached.
+    A threshold is recorded only once its alert was sent (or can never be, e.g. with DMs closed); otherwise the user
+    is checked again after BUDGET_ALERT_RETRY_DELAY seconds.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        user_id = await db.next_budget_check()
+        try:
+            user = None
+            for budget in await db.check_budget_thresholds(user_id):
+                if budget["percent"] > budget["previous_percent"]:
+                    try:
+                        user = user or await bot.fetch_user(int(user_id))
+                        icon = "🚨" if budget["percent"] >= 100 else "⚠️"
+                        await user.send(f"{icon} You have spent {budget['spent']:.2f} ILS, {budget['percent']}% of "
+                                        f"your {describe_budget(budget)} of {budget['amount']:.2f} ILS.")
+                    except (discord.Forbidden, discord.NotFound) as e:
+                        logger.warning(f"Can't send budget alerts to {user_id}, skipping them: {e!r}")
+                # Lowered thresholds (after expenses were deleted) are just recorded.
+                await db.record_budget_alert(budget)
+        except Exception:
+            logger.exception(f"Failed to deliver budget alerts to {user_id}, retrying in {BUDGET_ALERT_RETRY_DELAY}s")
+            loop.call_later(BUDGET_ALERT_RETRY_DELAY, db.queue_budget_check, user_id)
 
 
 ##### Breakdown #####
@@ -132,172 +476,172 @@ def get_group_key(expense_dt, group_by):
         return format_time(expense_dt)
 
 
-def group_expenses(expenses_dict, group_by, specific_location=None):
-    """
-    Groups expenses by year or month/year. If group_by is a literal "yyyy" or "mm/yy",
-    then all matching expenses are grouped accordingly.
-    If group_by is a specific filter (e.g., "2025" or "05/25"), then only expenses matching
-    that filter are added.
-    """
-    grouped = defaultdict(list)
-    for loc, expenses in expenses_dict.items():
-        if specific_location and loc.lower() != specific_location.lower():
-            continue
-        for expense in expenses:
-            dt = expense["timestamp"]
-            # When group_by is a literal option, group all expenses accordingly.
-            if group_by in {"yyyy", "mm/yy"}:
-                key = get_group_key(dt, group_by)
-                expense['location'] = loc
-                grouped[key].append(expense)
-            # Otherwise, treat group_by as a specific filter.
-            else:
-                if re.match(r"^\d{4}$", group_by):  # specific year, e.g., "2025"
-                    key = dt.strftime("%Y")
-                    if key == group_by:
-                        expense['location'] = loc
-                        grouped[key].append(expense)
-                elif re.match(r"^\d{2}/\d{2}$", group_by):  # specific month/year, e.g., "05/25"
-                    key = dt.strftime("%m/%y")
-                    if key == group_by:
-                        expense['location'] = loc
-                        grouped[key].append(expense)
-    return grouped
-
-
-def format_expense(expense):
-    formatted_dt = format_time(expense['timestamp'])
-    return f"* {expense['amount']:.2f} ILS on {formatted_dt} ({expense['original_amount']} {expense['currency']})\n"
-
-
-def calculate_total(expenses):
-    return sum(expense["amount"] for expense in expenses)
+def shorten(text, limit=DESCRIPTION_LIMIT):
+    return text if len(text) <= limit else text[:limit - 1] + "…"
 
 
-async def perform_breakdown(interaction: discord.Interaction, _location: str = None, _group_by: str = None):
-    async def _breakdown_no_grouping():
-        if _location:
-            total_ils = sum(exp["amount"] for exp in _breakdown.get(_location.lower(), []))
-            response = f"📊 **Expense Breakdown for {_location}:**\n"
-            for expense in _breakdown.get(_location.lower(), []):
-                formatted = format_time(expense['timestamp'])
-                response += f"* {expense['amount']:.2f} ILS on {formatted} ({expense['original_amount']} {expense['currency']})\n"
-            response += f"**Total**: {total_ils:.2f} ILS\n"
-        else:
-            response = "📊 **Expense Breakdown:**\n"
-            total_ils = 0
-            for loc, expenses in _breakdown.items():
-                response += f"**{loc}:**\n"
-                for expense in expenses:
-                    formatted = format_time(expense['timestamp'])
-                    response += f"* {expense['amount']:.2f} ILS on {formatted} ({expense['original_amount']} {expense['currency']})\n"
-                    total_ils += expense['amount']
-                response += f"**Total**: {total_ils:.2f} ILS\n"
-        await interaction.response.send_message(response)
-
-    async def _group_by_literals():
-        # Group expenses by literal (_group_by) first.
-        grouped_expenses = group_expenses(_breakdown, _group_by, _location)
-        _response = f"📊 **Expense Breakdown{' for ' + _location if _location else ''}:**\n"
-        _grand_total = 0
-
-        # If no expenses were grouped, show a message.
-        if not grouped_expenses:
-            await interaction.response.send_message(f"📊 No expenses match the filter '{_group_by}'.")
-            return
+def format_expense(expense, show_id=False, currency="ILS", rate=None):
+    """Formats an expense in `currency`, converting its original amount by `rate` if given."""
+    formatted_dt = format_time(expense.timestamp)
+    expense_id = f"[{expense.id}] " if show_id else ""
+    amount = expense.amount if rate is None else float(expense.original_amount) * rate
+    description = f" - {shorten(expense.description)}" if expense.description else ""
+    return f"* {expense_id}{amount:.2f} {currency} on {formatted_dt} ({expense.original_amount} {expense.currency})" \
+           f"{description}"
 
-        # For each literal group (e.g. "2025" or "05/25")
-        for literal_key, literal_expenses in grouped_expenses.items():
-            _response += f"**{literal_key}:**\n"
-            # If no specific location was provided, further group by location.
-            if not _location:
-                # Group by location using a temporary dict.
-                location_group = {}
-                for _expense in literal_expenses:
-                    # Assumes each expense has a "location" field.
-                    _loc = _expense.get("location", "Unknown")
-                    location_group.setdefault(_loc, []).append(_expense)
-                for _loc, loc_expenses in location_group.items():
-                    _response += f"**{_loc}:**\n"
-                    for _expense in loc_expenses:
-                        _response += format_expense(_expense)
-                    _group_total = calculate_total(loc_expenses)
-                    _response += f"**Subtotal:** {_group_total:.2f} ILS\n\n"
-                    _grand_total += _group_total
-            else:
-                # If a specific location is provided, just list the expenses.
-                for _expense in literal_expenses:
-                    _response += format_expense(_expense)
-                _group_total = calculate_total(literal_expenses)
-                _response += f"**Subtotal:** {_group_total:.2f} ILS\n\n"
-                _grand_total += _group_total
-
-        _response += f"**Grand Total:** {_grand_total:.2f} ILS\n"
-        await interaction.response.send_message(_response)
-
-    def _group_by_location():
-        _filtered_breakdown = {}
-        for _loc, _expenses in _breakdown.items():
-            if _location and _loc.lower() != _location.lower():
-                continue
-            filtered = []
-            for _expense in _expenses:
-                dt = _expense["timestamp"]
-                if re.match(r"^\d{4}$", _group_by):  # specific year filter
-                    if dt.strftime("%Y") == _group_by:
-                        filtered.append(_expense)
-                elif re.match(r"^\d{2}/\d{2}$", _group_by):  # specific month/year filter
-                    if dt.strftime("%m/%y") == _group_by:
-                        filtered.append(_expense)
-            if filtered:
-                _filtered_breakdown[_loc] = filtered
-        return _filtered_breakdown
-
-    _breakdown = await db.get_breakdown(interaction.user.id, _location.lower() if _location else None)
-    if not _breakdown:
-        message = f"📊 No expenses recorded for **{_location}**." if _location else "📊 No expenses recorded yet."
-        await interaction.response.send_message(message)
-        return
-
-    # No grouping/filter option provided: use default behavior.
-    if not _group_by:
-        await _breakdown_no_grouping()
-        return
 
-    # Check if _group_by is a literal grouping option ("yyyy" or "mm/yy")
+async def perform_breakdown(interaction: discord.Interaction, _location: str = None, _group_by: str = None):
+    # A specific filter (e.g., "2025" or "05/25") must be a 4-digit year or a mm/yy string.
     valid_literals = {"yyyy", "mm/yy"}
-    if _group_by in valid_literals:
-        await _group_by_literals()
-        return
-
-    # Otherwise, _group_by is a specific filter (e.g., "2025" or "05/25")
-    # Validate that it matches a 4-digit year or a mm/yy format.
-    if not (re.match(r"^\d{4}$", _group_by) or re.match(r"^\d{2}/\d{2}$", _group_by)):
+    if _group_by and _group_by not in valid_literals and period_bounds(_group_by) is None:
         await interaction.response.send_message(
             "❌ Invalid grouping option. Use 'yyyy' or 'mm/yy', or pass a valid year (e.g., 2025) or month/year (e.g., 05/25)."
         )
         return
 
-    # Filter expenses by the specific _group_by value, grouping them by location.
-    filtered_breakdown = _group_by_location()
+    location = _location.lower() if _location else None
+    currency = await db.get_currency(interaction.user.id)
+    if not _group_by:
+        # No grouping/filter option provided: list expenses per location, or just the requested location.
+        paginator = ExpensePaginator(interaction.user.id, f"📊 **Expense Breakdown{' for ' + _location if _location else ''}:**",
+                                     location=location, levels=[] if _location else ["location"], currency=currency)
+        empty_message = f"📊 No expenses recorded for **{_location}**." if _location else "📊 No expenses recorded yet."
+    elif _group_by in valid_literals:
+        # Group expenses by literal (_group_by) first, then by location unless a specific location was provided.
+        paginator = ExpensePaginator(interaction.user.id, f"📊 **Expense Breakdown{' for ' + _location if _location else ''}:**",
+                                     location=location, group_by=_group_by,
+                                     levels=["period"] if _location else ["period", "location"], currency=currency)
+        empty_message = f"📊 No expenses recorded for **{_location}**." if _location else "📊 No expenses recorded yet."
+    else:
+        # _group_by is a specific filter (e.g., "2025" or "05/25"): only matching expenses, grouped by location.
+        paginator = ExpensePaginator(interaction.user.id, f"📊 **Expense Breakdown:**\n**{_group_by}:**",
+                                     location=location, period=_group_by, levels=["location"], currency=currency)
+        empty_message = f"📊 No expenses match the filter '{_group_by}'."
+
+    await send_paginated(interaction, paginator, empty_message)
+
+
+##### Pagination #####
+class ExpensePaginator:
+    """
+    Renders a user's expenses as Discord-sized pages, fetching each page lazily with keyset pagination.
+    Expenses are nested under a heading per grouping level ("period" and/or "location"); with show_totals,
+    each innermost group ends with its subtotal and the last page ends with the grand total. Amounts are shown in
+    `currency`, converted from the original amounts at current rates unless it is the base currency. With `search`,
+    only the expenses whose description matches it are listed, along with their descriptions.
+    """
 
-    if not filtered_breakdown:
-        await interaction.response.send_message(f"📊 No expenses match the filter '{_group_by}'.")
+    def __init__(self, user_id, header, location=None, period=None, group_by=None, levels=("location",),
+                 show_ids=False, show_totals=True, currency="ILS", search=None):
+        self.user_id = user_id
+        self.header = header
+        self.location = location
+        self.period = period
+        self.group_by = group_by
+        self.levels = list(levels)
+        self.show_ids = show_ids
+        self.show_totals = show_totals
+        self.currency = currency
+        self.search = search
+        self._group_totals = None
+        self._version = None
+
+    def _sort_key(self, expense):
+        sort_key = (expense.location, expense.timestamp, expense.id)
+        return (expense.period,) + sort_key if self.group_by else sort_key
+
+    def _group_of(self, expense):
+        return tuple(getattr(expense, level) for level in self.levels)
+
+    def _heading(self, level, value):
+        return f"**{get_group_key(value, self.group_by) if level == 'period' else value}:**"
+
+    async def _get_group_totals(self):
+        if self._group_totals is None:
+            self._group_totals = await db.get_group_totals(self.user_id, self.group_by if "period" in self.levels else None,
+                                                           "location" in self.levels, self.location, self.period,
+                                                           self.currency)
+        return self._group_totals
+
+    async def _closing_lines(self, group, is_last):
+        """Subtotal of the group that just ended, followed by the grand total on the last page."""
+        if not self.show_totals:
+            return []
+        group_totals = await self._get_group_totals()
+        if not self.levels:
+            return [f"**Total**: {group_totals.get((), 0):.2f} {self.currency}"] if is_last else []
+        lines = [f"**Subtotal:** {group_totals.get(group, 0):.2f} {self.currency}", ""]
+        if is_last:
+            lines.append(f"**Grand Total:** {sum(group_totals.values()):.2f} {self.currency}")
+        return lines
+
+    async def get_page(self, cursor=None):
+        """
+        Returns the content of the page starting after `cursor` (the last expense of the previous page) and the cursor
+        of the next page, or None as the cursor if this is the last page. The content is None if there are no expenses.
+        Pages are cached until the user's data changes.
+        """
+        version = db.get_data_version(self.user_id)
+        if version != self._version:
+            # The group totals were summed before the data changed.
+            self._group_totals, self._version = None, version
+        key = ("page", self.header, self.location, self.period, self.group_by, tuple(self.levels), self.show_ids,
+               self.show_totals, self.currency, self.search, self._sort_key(cursor) if cursor else None)
+        return await get_cached_response(self.user_id, key, lambda: self._render_page(cursor))
+
+    async def _render_page(self, cursor):
+        expenses = await db.get_expenses_page(self.user_id, self.location, self.period, self.group_by,
+                                              after=self._sort_key(cursor) if cursor else None, limit=PAGE_ROWS + 1,
+                                              search=self.search)
+        if not expenses and cursor is None:
+            return None, None
+        cross_rates = await db.get_cross_rates() if self.currency != db.BASE_CURRENCY else None
+
+        lines = [self.header]
+        length = len(self.header) + 1
+        previous_group = None
+        rendered = 0
+        for expense in expenses[:PAGE_ROWS]:
+            group = self._group_of(expense)
+            chunk = []
+            if previous_group is not None and group != previous_group:
+                chunk.extend(await self._closing_lines(previous_group, is_last=False))
+            # Every page repeats the headings of the group it starts in.
+            for depth, level in enumerate(self.levels):
+                if previous_group is None or group[:depth + 1] != previous_group[:depth + 1]:
+                    chunk.append(self._heading(level, group[depth]))
+            rate = cross_rates.rate(expense.currency, self.currency) if cross_rates else None
+            chunk.append(format_expense(expense, self.show_ids, self.currency, rate))
+
+            chunk_length = sum(len(line) + 1 for line in chunk)
+            if rendered and length + chunk_length + CLOSING_RESERVE > MESSAGE_LIMIT:
+                break
+            lines.extend(chunk)
+            length += chunk_length
+            previous_group = group
+            rendered += 1
+
+        # Close the last group on this page if the next page starts a new one (CLOSING_RESERVE keeps room for it).
+        has_more = rendered < len(expenses)
+        if rendered and (not has_more or self._group_of(expenses[rendered]) != previous_group):
+            lines.extend(await self._closing_lines(previous_group, is_last=not has_more))
+        last_expense = expenses[rendered - 1] if expenses else None
+        return "\n".join(lines), last_expense if has_more else None
+
+
+async def send_paginated(interaction: discord.Interaction, paginator: ExpensePaginator, empty_message: str,
+                         ephemeral: bool = False):
+    content, next_cursor = await paginator.get_page()
+    if content is None:
+        await interaction.response.send_message(empty_message, ephemeral=ephemeral)
+        return
+    if next_cursor is None:
+        await interaction.response.send_message(content, ephemeral=ephemeral)
         return
 
-    # Build the response with a top-level header for the filter, then group by location.
-    response = "📊 **Expense Breakdown:**\n"
-    response += f"**{_group_by}:**\n"
-    grand_total = 0
-    for loc, expenses in filtered_breakdown.items():
-        response += f"**{loc}:**\n"
-        for expense in expenses:
-            response += format_expense(expense)
-        group_total = calculate_total(expenses)
-        response += f"**Subtotal:** {group_total:.2f} ILS\n\n"
-        grand_total += group_total
-    response += f"**Grand Total:** {grand_total:.2f} ILS\n"
-    await interaction.response.send_message(response)
+    view = PaginationView(interaction.user.id, paginator.get_page, next_cursor)
+    await interaction.response.send_message(content, view=view, ephemeral=ephemeral)
+    view.message = await interaction.original_response()
 
 
 ##### Location #####
@@ -310,6 +654,28 @@ async def perform_location(interaction: discord.Interaction, place: str = None):
         await interaction.response.send_message(f"📍 Current location is set to {current_location}!")
 
 
+##### Currency #####
+async def perform_currency(interaction: discord.Interaction, code: str = None):
+    if not code:
+        currency = await db.get_currency(interaction.user.id)
+        await interaction.response.send_message(f"💱 Your reports are shown in {currency}.")
+        return
+
+    code = code.upper()
+    if code not in db.VALID_CURRENCIES:
+        await interaction.response.send_message("⚠️ Invalid currency. Use a supported currency code.", ephemeral=True)
+        return
+    await db.set_currency(interaction.user.id, code)
+    await interaction.response.send_message(f"💱 Your reports will be shown in {code}.")
+
+
+##### Rebuild totals #####
+async def perform_rebuild_totals(interaction: discord.Interaction):
+    groups = await db.rebuild_expense_totals(interaction.user.id)
+    await interaction.response.send_message(f"🔄 Rebuilt your totals from {groups} location/month/currency groups.",
+                                            ephemeral=True)
+
+
 ##### Delete #####
 async def perform_delete(interaction: discord.Interaction, expense_id: str):
     # Ownership validation.
@@ -349,54 +715,89 @@ async def perform_delete(interaction: discord.Interaction, expense_id: str):
 
 ##### List #####
 async def perform_list_expenses(interaction: discord.Interaction, _filter: str = None):
-    # Retrieve all expenses breakdown for the user.
-    _breakdown = await db.get_breakdown(interaction.user.id, requires_id=True)
-    if not _breakdown:
-        await interaction.response.send_message("📊 No expenses recorded yet.", ephemeral=True)
-        return
-
     # If no filter is provided, list all expenses grouped by location.
     if not _filter:
-        response = "📊 **All Expenses:**\n"
-        for loc, expenses in _breakdown.items():
-            response += f"**{loc}:**\n"
-            for expense in expenses:
-                formatted = format_time(expense['timestamp'])
-                response += f"* [{expense['id']}] {expense['amount']:.2f} ILS on {formatted} ({expense['original_amount']} {expense['currency']})\n"
-        await interaction.response.send_message(response)
+        paginator = ExpensePaginator(interaction.user.id, "📊 **All Expenses:**", show_ids=True, show_totals=False,
+                                     currency=await db.get_currency(interaction.user.id))
+        await send_paginated(interaction, paginator, "📊 No expenses recorded yet.")
         return
 
     # Validate _filter: must be a 4-digit year or a mm/yy string.
-    if not (re.match(r"^\d{4}$", _filter) or re.match(r"^\d{2}/\d{2}$", _filter)):
+    if period_bounds(_filter) is None:
         await interaction.response.send_message(
             "❌ Invalid filter. Use a 4-digit year (e.g., 2025) or month/year (e.g., 05/25).", ephemeral=True
         )
         return
 
-    # Filter expenses based on _filter.
-    filtered_breakdown = {}
-    for loc, expenses in _breakdown.items():
-        filtered = []
-        for expense in expenses:
-            dt = expense["timestamp"]
-            if re.match(r"^\d{4}$", _filter):
-                if dt.strftime("%Y") == _filter:
-                    filtered.append(expense)
-            elif re.match(r"^\d{2}/\d{2}$", _filter):
-                if dt.strftime("%m/%y") == _filter:
-                    filtered.append(expense)
-        if filtered:
-            filtered_breakdown[loc] = filtered
-
-    if not filtered_breakdown:
-        await interaction.response.send_message(f"📊 No expenses match the filter '{_filter}'.", ephemeral=True)
-        return
-
-    # Build the response, grouping by location.
-    response = f"📊 **Expenses for {_filter}:**\n"
-    for loc, expenses in filtered_breakdown.items():
-        response += f"**{loc}:**\n"
-        for expense in expenses:
-            formatted = format_time(expense['timestamp'])
-            response += f"* [{expense['id']}] {expense['amount']:.2f} ILS on {formatted} ({expense['original_amount']} {expense['currency']})\n"
-    await interaction.response.send_message(response)
+    # Filter expenses based on _filter in the database, grouping by location.
+    paginator = ExpensePaginator(interaction.user.id, f"📊 **Expenses for {_filter}:**", period=_filter,
+                                 show_ids=True, show_totals=False, currency=await db.get_currency(interaction.user.id))
+    await send_paginated(interaction, paginator, f"📊 No expenses match the filter '{_filter}'.")
+
+
+##### Search #####
+async def perform_search(interaction: discord.Interaction, query: str, _filter: str = None, _location: str = None):
+    query = query.strip()
+    if not query:
+        await interaction.response.send_message("❌ Please enter something to search for.", ephemeral=True)
+        return
+
+    # Validate _filter: must be a 4-digit year or a mm/yy string.
+    if _filter and period_bounds(_filter) is None:
+        await interaction.response.send_message(
+            "❌ Invalid filter. Use a 4-digit year (e.g., 2025) or month/year (e.g., 05/25).", ephemeral=True
+        )
+        return
+
+    scope = (f" in {shorten(_location)}" if _location else "") + (f" for {_filter}" if _filter else "")
+    paginator = ExpensePaginator(interaction.user.id, f"🔎 **Expenses matching '{shorten(query)}'{scope}:**",
+                                 location=_location.lower() if _location else None,
+                                 period=_filter, show_ids=True, show_totals=False,
+                                 currency=await db.get_currency(interaction.user.id), search=query)
+    await send_paginated(interaction, paginator, f"🔎 No expenses match '{shorten(query)}'{scope}.")
+
+
+##### Db stats #####
+async def perform_db_stats(interaction: discord.Interaction):
+    stats = db.get_pool_stats()
+    statements = stats["statements"]
+    lines = [
+        "🗄️ **Database pool:**",
+        f"Connections: {stats['size']} open ({stats['min_size']}-{stats['max_size']}), {stats['idle']} idle, "
+        f"{stats['in_use']} in use (peak {stats['peak_in_use']})",
+        f"Acquire wait: {stats['acquire'].summary()}",
+        f"Prepared statements: {statements['hits']} hits, {statements['misses']} misses",
+        "",
+        "🐢 **Slowest queries (by p95):**",
+    ]
+    queries = sorted(stats["queries"].items(), key=lambda item: item[1].percentile(95), reverse=True)
+    content = "\n".join(lines)
+    for name, query_stats in queries:
+        line = f"`{name}`: {query_stats.summary()}"
+        if len(content) + len(line) + 1 > MESSAGE_LIMIT:
+            break
+        content += "\n" + line
+    if not queries:
+        content += "\nNo queries recorded yet."
+    cache = response_cache.get_stats()
+    line = (f"\n💾 **Response cache:** {cache['entries']}/{cache['max_entries']} entries, {cache['size'] / 1024:.1f} KiB, "
+            f"{cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%}), {cache['evictions']} evictions")
+    if len(content) + len(line) + 1 <= MESSAGE_LIMIT:
+        content += "\n" + line
+    await interaction.response.send_message(content, ephemeral=True)
+
+
+##### Trace stats #####
+async def perform_trace_stats(interaction: discord.Interaction):
+    if not traces:
+        await interaction.response.send_message("⏱️ No calls recorded yet.", ephemeral=True)
+        return
+
+    # Slowest first, so whatever doesn't fit the message is the least interesting.
+    content = "⏱️ **Command and db call latency (by p95):**"
+    for name, stats in sorted(traces.items(), key=lambda item: item[1].percentile(95), reverse=True):
+        line = f"`{name}`: {stats.summary()}"
+        if len(content) + len(line) + 1 > MESSAGE_LIMIT:
+            break
+        content += "\n" + line
+    await interaction.response.send_message(content, ephemeral=True)
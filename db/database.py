@@ -1,155 +1,871 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import aiohttp
 import asyncpg
-import requests
 
+from db.migrations import MIGRATIONS
+from db.models import Expense
+from db.statements import STATEMENTS, STATEMENT_NAMES, Connection
 from utils import config
+from utils.common_funcs import period_bounds, utc_now
+from utils.exchange_rates import CrossRates, rate_provider
+from utils.expense_charts import ChartCache
+from utils.expense_import import ImportRowError, MAX_AMOUNT, parse_import_row
+from utils.expense_stats import ExpenseStats
+from utils.metrics import LatencyStats, traced_methods
+from utils.prefix_index import PrefixIndex
+from utils.trip_ledger import split_evenly
+
+logger = logging.getLogger(__name__)
 
 
+@traced_methods("db", exclude=("close", "refresh_exchange_rates_periodically", "refresh_valid_currencies_periodically",
+                               "next_budget_check", "listen_for_invalidations"))
 class Database:
     def __init__(self):
         self.db = None
         self.BASE_CURRENCY = "ILS"
-        self.EXCHANGE_API_URL = f"https://v6.exchangerate-api.com/v6/{config.EXCHANGE_API_KEY}/latest/"
-        self.VALID_CURRENCIES = self.load_valid_currencies()
+        self.GROUP_BY_TRUNC = {"yyyy": "year", "mm/yy": "month"}
+        self.MIGRATIONS_LOCK_ID = 7_385_021
+        self.IMPORT_BATCH_SIZE = 5000
+        self.EXPORT_BATCH_SIZE = 1000
+        self.BUDGET_THRESHOLDS = [50, 80, 100]
+        self.INVALIDATION_CHANNEL = "cache_invalidation"
+        # Notifications are capped at 8000 bytes by PostgreSQL.
+        self.MAX_NOTIFICATION_SIZE = 7900
+        self.PROCESS_ID = uuid.uuid4().hex
+        self.rates = rate_provider
+        self.VALID_CURRENCIES = set()
+        self.currency_index = PrefixIndex()
+        self.location_index = defaultdict(PrefixIndex)
+        self.location_cache = {}
+        self.currency_cache = {}
+        self.cross_rates = None
+        self.cross_rates_table = None
+        self.stored_rate_cache = {}
+        self.stats_cache = {}
+        self.data_versions = defaultdict(int)
+        self.chart_cache = ChartCache(config.CHART_CACHE_SIZE)
+        self.budget_checks = asyncio.Queue()
+        self.pending_budget_checks = set()
+        self.statement_stats = {"hits": 0, "misses": 0}
+        self.acquire_stats = LatencyStats()
+        self.query_stats = defaultdict(LatencyStats)
+        self.connections_in_use = 0
+        self.peak_connections_in_use = 0
+        self.background_tasks = set()
 
     async def connect(self):
         if self.db is None:
-            self.db = await asyncpg.create_pool(config.DATABASE_URL)
+            self.db = await asyncpg.create_pool(
+                config.DATABASE_URL,
+                min_size=config.DB_POOL_MIN_SIZE,
+                max_size=config.DB_POOL_MAX_SIZE,
+                statement_cache_size=config.DB_STATEMENT_CACHE_SIZE,
+                command_timeout=config.DB_COMMAND_TIMEOUT,
+                max_inactive_connection_lifetime=config.DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+                connection_class=Connection,
+                init=self._init_connection
+            )
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Acquire a pooled connection, recording how long it took and how many connections are in use."""
+        start = time.perf_counter()
+        try:
+            conn = await self.db.acquire(timeout=config.DB_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.acquire_stats.record(time.perf_counter() - start, error=True)
+            raise
+        self.acquire_stats.record(time.perf_counter() - start)
+        self.connections_in_use += 1
+        self.peak_connections_in_use = max(self.peak_connections_in_use, self.connections_in_use)
+        try:
+            yield conn
+        finally:
+            self.connections_in_use -= 1
+            await self.db.release(conn)
+
+    def get_pool_stats(self) -> dict:
+        """Current pool usage, along with the acquire wait and per-query latency recorded so far."""
+        return {
+            "size": self.db.get_size(),
+            "idle": self.db.get_idle_size(),
+            "min_size": self.db.get_min_size(),
+            "max_size": self.db.get_max_size(),
+            "in_use": self.connections_in_use,
+            "peak_in_use": self.peak_connections_in_use,
+            "acquire": self.acquire_stats,
+            "statements": dict(self.statement_stats),
+            "queries": dict(self.query_stats),
+        }
+
+    def _record_query(self, record):
+        name = STATEMENT_NAMES.get(record.query) or " ".join(record.query.split())[:60]
+        self.query_stats[name].record(record.elapsed, error=record.exception is not None)
+
+    async def _init_connection(self, conn):
+        """Prepare every registered statement on a new pooled connection, and time its queries."""
+        conn.add_query_logger(self._record_query)
+        try:
+            for name in STATEMENTS:
+                await conn.prepare_registered(name)
+        except (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError):
+            # The schema isn't migrated yet; create_tables() recycles the pool's connections once it is.
+            pass
+        # Preparing leaves the implicit transaction (and its table locks) open until the next synced query,
+        # which would block migrations while the connection sits idle in the pool.
+        await conn.execute("SELECT 1")
+
+    async def _run(self, conn, method, name, *args):
+        """Run the registered statement `name` with conn.<method> (fetch, fetchrow, fetchval or execute)."""
+        # A statement evicted from asyncpg's LRU statement cache (or expired from it) is parsed and planned again.
+        self.statement_stats["hits" if conn.is_cached(name) else "misses"] += 1
+        return await getattr(conn, method)(STATEMENTS[name], *args)
+
+    def start_background_task(self, coro):
+        """Run `coro` in the background for the lifetime of the connection; it is cancelled by close()."""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    async def close(self):
+        for task in list(self.background_tasks):
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        await self.rates.close()
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
 
     async def create_tables(self):
-        async with self.db.acquire() as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS expenses (
-                    id SERIAL PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    amount NUMERIC(10, 2) NOT NULL,
-                    currency TEXT NOT NULL,
-                    converted_amount NUMERIC(10, 2) NOT NULL,
-                    description TEXT NOT NULL,
-                    location TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
+        """Bring the schema up to date by applying any pending migrations, in order."""
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                # Serialize concurrent startups so each migration is applied exactly once.
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", self.MIGRATIONS_LOCK_ID)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                current_version = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+                for version, migration in enumerate(MIGRATIONS, start=1):
+                    if version <= current_version:
+                        continue
+                    logger.info(f"Applying schema migration {version}")
+                    await conn.execute(migration)
+                    await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1)", version)
+        if current_version < len(MIGRATIONS):
+            # Statements prepared against the old schema are stale; reconnect so they are prepared again.
+            await self.db.expire_connections()
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS user_locations (
-                    user_id TEXT PRIMARY KEY,
-                    location TEXT NOT NULL
-                );
-            """)
+    async def get_conversion_rate(self, from_currency, date=None):
+        """
+        Get the rate from `from_currency` to the base currency from the rate history.
+        For today's rate (no `date`), a history older than today falls back to the live API, and an unavailable API
+        falls back to the latest stored rate. For a past `date`, the latest rate stored on or before it is used.
+        """
+        from_currency = from_currency.upper()
+        if from_currency == self.BASE_CURRENCY:
+            return 1.0
+        today = datetime.now(timezone.utc).date()
+        cached = self.stored_rate_cache.get(from_currency)
+        if date is None and cached and cached[0] == today:
+            return cached[1]
+        async with self.acquire() as conn:
+            row = await self._run(conn, "fetchrow", "get_conversion_rate", from_currency, self.BASE_CURRENCY, date or today)
+        if row and row["date"] == today:
+            self.stored_rate_cache[from_currency] = (today, float(row["rate"]))
+        if row and (date or row["date"] == today):
+            return float(row["rate"])
+        if date:
+            return None
+
+        try:
+            return await self.rates.get_rate(from_currency, self.BASE_CURRENCY)
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            if not row:
+                raise
+            logger.warning(f"Exchange rate API unavailable, using {from_currency} rate from {row['date']}: {e!r}")
+            return float(row["rate"])
+
+    async def store_exchange_rates(self, base_currency, rates, date):
+        """Record a rate table for `base_currency` in the history, in both directions of every pair."""
+        records = [(date, base_currency, code, rate) for code, rate in rates.items()] + \
+                  [(date, code, base_currency, 1 / rate) for code, rate in rates.items() if rate]
+        async with self.acquire() as conn:
+            await conn.executemany("""
+                INSERT INTO exchange_rates (date, from_currency, to_currency, rate)
+                VALUES ($1, $2, $3, $4) ON CONFLICT (date, from_currency, to_currency) DO UPDATE SET rate = EXCLUDED.rate
+            """, records)
+        for _, from_currency, to_currency, rate in records:
+            if to_currency == self.BASE_CURRENCY:
+                self.stored_rate_cache[from_currency] = (date, float(rate))
+        self._publish("rates")
 
-    async def get_conversion_rate(self, from_currency):
-        response = requests.get(f"{self.EXCHANGE_API_URL}{from_currency}")
-        data = response.json()
-        return data["conversion_rates"].get(self.BASE_CURRENCY, 1.0)
+    async def refresh_exchange_rates(self):
+        """Fetch today's rate table for the base currency and add it to the rate history."""
+        try:
+            rates = await self.rates.get_rates(self.BASE_CURRENCY)
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            logger.warning(f"Failed to refresh exchange rate history: {e!r}")
+            return
+        await self.store_exchange_rates(self.BASE_CURRENCY, rates, datetime.now(timezone.utc).date())
+        logger.info(f"Stored {len(rates)} {self.BASE_CURRENCY} exchange rates")
+
+    async def refresh_exchange_rates_periodically(self):
+        while True:
+            await self.refresh_exchange_rates()
+            await asyncio.sleep(config.RATE_HISTORY_REFRESH_INTERVAL)
+
+    async def get_cross_rates(self) -> CrossRates:
+        """
+        Current rates between every pair of currencies, built from one fetch of the base currency's rate table (or,
+        if the API is unavailable, the latest stored one). The matrix is only rebuilt when the rate table changes.
+        """
+        try:
+            rates = await self.rates.get_rates(self.BASE_CURRENCY)
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            if self.cross_rates is not None:
+                return self.cross_rates
+            logger.warning(f"Exchange rate API unavailable, using the stored {self.BASE_CURRENCY} rates: {e!r}")
+            async with self.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT DISTINCT ON (to_currency) to_currency, rate FROM exchange_rates
+                    WHERE from_currency = $1
+                    ORDER BY to_currency, date DESC
+                """, self.BASE_CURRENCY)
+            if not rows:
+                raise
+            rates = {row["to_currency"]: row["rate"] for row in rows}
+        if rates is not self.cross_rates_table:
+            self.cross_rates, self.cross_rates_table = CrossRates(self.BASE_CURRENCY, rates), rates
+        return self.cross_rates
+
+    async def _sum_total(self, currency, args):
+        """
+        SQL summing the expense_totals rollup in `currency`: the stored base currency totals, or otherwise the original
+        total of each currency bucket times its current cross-rate (the rates are appended to `args`).
+        """
+        if not currency or currency == self.BASE_CURRENCY:
+            return "SUM(total)"
+        cross_rates = await self.get_cross_rates()
+        args.extend([cross_rates.codes, cross_rates.factors(cross_rates.codes, currency).tolist()])
+        return f"SUM(original_total::FLOAT8 * (${len(args)}::FLOAT8[])[array_position(${len(args) - 1}::TEXT[], currency)])"
 
     async def add_expense(self, user_id, amount, currency, description):
-        user_location = await self.get_location(user_id)
-        if not user_location:
-            return None
+        """
+        Insert an expense at the user's current location and return its id, None if the user has no location set,
+        or False if the currency is not supported. A cached location (or an uncached one, resolved by the INSERT
+        itself) and a cached rate make this a single round trip.
+        """
         if currency.upper() not in self.VALID_CURRENCIES:
             return False
         conversion_rate = await self.get_conversion_rate(currency)
         converted_amount = amount * conversion_rate
-        async with self.db.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO expenses (user_id, amount, currency, converted_amount, description, location)
-                VALUES ($1, $2, $3, $4, $5, $6)
-            """, str(user_id), amount, currency.upper(), converted_amount, description, user_location)
-        return True
+        user_location = self.location_cache.get(str(user_id))
+        async with self.acquire() as conn:
+            if user_location:
+                expense_id = await self._run(conn, "fetchval", "add_expense", str(user_id), amount, currency.upper(),
+                                             converted_amount, description, user_location)
+                self._expenses_changed(user_id, [user_location])
+                return expense_id
+
+            row = await self._run(conn, "fetchrow", "add_expense_at_current_location", str(user_id), amount,
+                                  currency.upper(), converted_amount, description)
+        if not row:
+            return None
+        self.location_cache[str(user_id)] = row["location"]
+        self._expenses_changed(user_id, [row["location"]])
+        return row["id"]
+
+    async def add_trip_expense(self, user_id, trip_id, amount, currency, description, participants):
+        """
+        Insert an expense the user paid for a trip, split evenly between `participants` (members of the trip), and
+        return its id, None if the user has no location set, or False if the currency is not supported. The expense and
+        its shares are written in one transaction, in which the expense_splits triggers update the members' balances.
+        """
+        if currency.upper() not in self.VALID_CURRENCIES:
+            return False
+        location = await self.get_location(user_id)
+        if not location:
+            return None
+        conversion_rate = Decimal(str(await self.get_conversion_rate(currency)))
+        converted_amount = round(Decimal(str(amount)) * conversion_rate, 2)
+        shares = split_evenly(converted_amount, participants)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                expense_id = await self._run(conn, "fetchval", "add_expense", str(user_id), amount, currency.upper(),
+                                             converted_amount, description, location)
+                await conn.execute("""
+                    INSERT INTO expense_splits (expense_id, trip_id, payer_id, user_id, share)
+                    SELECT $1, $2, $3, member, share FROM unnest($4::TEXT[], $5::NUMERIC[]) AS s(member, share)
+                """, expense_id, trip_id, str(user_id), list(shares), list(shares.values()))
+        self._expenses_changed(user_id, [location])
+        return expense_id
+
+    async def add_expenses(self, expenses):
+        """
+        Insert (user_id, amount, currency, description, location, timestamp) expenses, possibly of several users, with
+        a single COPY. Each distinct currency's conversion rate is looked up once. Returns the number of inserted rows.
+        """
+        columns = ("user_id", "amount", "currency", "converted_amount", "description", "location", "timestamp")
+        conversion_rates = {}
+        records = []
+        for user_id, amount, currency, description, location, timestamp in expenses:
+            if currency not in conversion_rates:
+                conversion_rates[currency] = Decimal(str(await self.get_conversion_rate(currency)))
+            amount = Decimal(str(amount))
+            records.append((str(user_id), amount, currency, round(amount * conversion_rates[currency], 2), description,
+                            location, timestamp))
+        async with self.acquire() as conn:
+            await conn.copy_records_to_table("expenses", records=records, columns=columns)
+        locations = defaultdict(set)
+        for record in records:
+            locations[record[0]].add(record[5].lower())
+        for user_id, user_locations in locations.items():
+            self._expenses_changed(user_id, user_locations)
+        return len(records)
+
+    async def import_expenses(self, user_id, rows):
+        """
+        Validate, convert and insert expenses from (line_number, raw row) pairs, in a single transaction and in
+        batches written with COPY. Each distinct currency's conversion rate is looked up once, before the transaction
+        starts, so no connection is held while waiting on a rate. If any row is invalid, ImportRowError is raised and
+        nothing is inserted. Returns the number of imported expenses.
+        """
+        default_location = await self.get_location(user_id)
+        default_timestamp = utc_now()
+        columns = ("user_id", "amount", "currency", "converted_amount", "description", "location", "timestamp")
+        parsed = [(line_number, *parse_import_row(line_number, row, self.VALID_CURRENCIES, default_location,
+                                                  default_timestamp))
+                  for line_number, row in rows]
+        conversion_rates = {}
+        for _, _, currency, *_ in parsed:
+            if currency not in conversion_rates:
+                conversion_rates[currency] = Decimal(str(await self.get_conversion_rate(currency)))
+
+        records = []
+        locations = set()
+        for line_number, amount, currency, description, location, timestamp in parsed:
+            converted_amount = round(amount * conversion_rates[currency], 2)
+            if abs(converted_amount) >= MAX_AMOUNT:
+                raise ImportRowError(line_number, f"converted amount '{converted_amount}' is too large")
+            records.append((str(user_id), amount, currency, converted_amount, description, location, timestamp))
+            locations.add(location.lower())
+
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                for start in range(0, len(records), self.IMPORT_BATCH_SIZE):
+                    await conn.copy_records_to_table("expenses", records=records[start:start + self.IMPORT_BATCH_SIZE],
+                                                     columns=columns)
+        self._expenses_changed(user_id, locations)
+        return len(records)
+
+    def _expenses_changed(self, user_id, locations=()):
+        """
+        Drop whatever is cached from a user's expenses after they were added to (at `locations`) or deleted, in this
+        process and, through a notification, in every other one.
+        """
+        self._apply_expenses_changed(str(user_id), locations)
+        # Budget thresholds are checked in the background, so the write itself isn't slowed down by them.
+        self.queue_budget_check(user_id)
+        self._publish("expenses", user_id, locations=sorted({location.lower() for location in locations}))
+
+    def _apply_expenses_changed(self, user_id: str, locations):
+        self.data_versions[user_id] += 1
+        self.stats_cache.pop(user_id, None)
+        self.chart_cache.invalidate(user_id)
+        for location in locations:
+            self.location_index[user_id].add(location.lower())
+
+    def _apply_location(self, user_id: str, location):
+        self.location_cache[user_id] = location
+        self.location_index[user_id].add(location.lower())
+        self.data_versions[user_id] += 1
+
+    def _apply_currency(self, user_id: str, currency):
+        self.currency_cache[user_id] = currency
+        self.data_versions[user_id] += 1
+
+    def _invalidate_all(self):
+        """Drop every per-user cache, for when invalidations from other processes may have been missed."""
+        self.stored_rate_cache.clear()
+        self.stats_cache.clear()
+        self.location_cache.clear()
+        self.currency_cache.clear()
+        for user_id in list(self.data_versions):
+            self.data_versions[user_id] += 1
+            self.chart_cache.invalidate(user_id)
+
+    def _publish(self, event, user_id=None, **data):
+        """Tell the other processes sharing the db (if CACHE_SYNC is on) to apply a cache invalidation."""
+        if not config.CACHE_SYNC:
+            return
+        message = {"origin": self.PROCESS_ID, "event": event, "user_id": user_id and str(user_id)}
+        payload = json.dumps({**message, **data})
+        if len(payload.encode()) > self.MAX_NOTIFICATION_SIZE:
+            # Too many (or too long) locations to send; the others still invalidate, just without indexing them.
+            payload = json.dumps(message)
+        self.start_background_task(self._notify(payload))
+
+    async def _notify(self, payload):
+        try:
+            async with self.acquire() as conn:
+                await conn.execute("SELECT pg_notify($1, $2)", self.INVALIDATION_CHANNEL, payload)
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to publish cache invalidation {payload}: {e!r}")
+
+    def _on_invalidation(self, conn, pid, channel, payload):
+        message = json.loads(payload)
+        if message["origin"] == self.PROCESS_ID:
+            return
+        event, user_id = message["event"], message["user_id"]
+        if event == "expenses":
+            self._apply_expenses_changed(user_id, message.get("locations", ()))
+        elif event in ("location", "currency"):
+            # Notifications are sent concurrently, so they may arrive out of order: rather than caching the value they
+            # carry, drop the cached one and let the next read get the current value from the db.
+            (self.location_cache if event == "location" else self.currency_cache).pop(user_id, None)
+            if message.get("location"):
+                self.location_index[user_id].add(message["location"].lower())
+            self.data_versions[user_id] += 1
+        elif event == "rates":
+            self.stored_rate_cache.clear()
+        elif event == "all":
+            self._invalidate_all()
+
+    async def listen_for_invalidations(self):
+        """
+        Apply the cache invalidations published by other processes, holding one pooled connection to LISTEN on.
+        Whenever the connection is (re)established everything cached is dropped, as notifications may have been missed.
+        """
+        while True:
+            try:
+                async with self.acquire() as conn:
+                    closed = asyncio.Event()
+                    conn.add_termination_listener(lambda _: closed.set())
+                    await conn.add_listener(self.INVALIDATION_CHANNEL, self._on_invalidation)
+                    self._invalidate_all()
+                    logger.info(f"Listening for cache invalidations as {self.PROCESS_ID}")
+                    try:
+                        await closed.wait()
+                    finally:
+                        if not conn.is_closed():
+                            await conn.remove_listener(self.INVALIDATION_CHANNEL, self._on_invalidation)
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Lost the cache invalidation listener, reconnecting: {e!r}")
+            await asyncio.sleep(5)
+
+    def get_data_version(self, user_id) -> int:
+        """A counter bumped whenever the user's expenses, location or currency change, for keying derived caches."""
+        return self.data_versions[str(user_id)]
+
+    async def get_expense_stats(self, user_id, currency=None) -> ExpenseStats:
+        """
+        Get a user's spending per day, location and currency as ExpenseStats, in `currency` if given (converted from
+        the original amounts at current rates) or else the base currency. The database does the per-day aggregation,
+        and the result is cached until the user's expenses change.
+        """
+        stats = self.stats_cache.get(str(user_id))
+        if stats is None:
+            async with self.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT timestamp::DATE AS day, location_key, currency, SUM(converted_amount)::FLOAT8,
+                           SUM(amount)::FLOAT8, COUNT(*)
+                    FROM expenses
+                    WHERE user_id = $1
+                    GROUP BY day, location_key, currency
+                    ORDER BY day
+                """, str(user_id))
+            stats = self.stats_cache[str(user_id)] = ExpenseStats.from_rows(rows)
+        if currency and currency != self.BASE_CURRENCY and len(stats):
+            cross_rates = await self.get_cross_rates()
+            stats = stats.in_currency(cross_rates.factors(stats.currencies, currency))
+        return stats
 
-    async def get_total_spent(self, user_id, location=None):
-        async with self.db.acquire() as conn:
+    async def get_total_spent(self, user_id, location=None, currency=None):
+        if currency and currency != self.BASE_CURRENCY:
+            where, args = self._expense_filters(user_id, location)
+            total = await self._sum_total(currency, args)
+            async with self.acquire() as conn:
+                result = await conn.fetchval(f"SELECT {total} FROM expense_totals WHERE {where}", *args)
+            return result if result else 0
+        async with self.acquire() as conn:
             if location:
-                result = await conn.fetchval("""
-                    SELECT SUM(converted_amount) FROM expenses WHERE user_id = $1 AND LOWER(location) = LOWER($2)
-                """, str(user_id), location)
+                result = await self._run(conn, "fetchval", "get_total_spent_at_location", str(user_id), location)
             else:
-                result = await conn.fetchval("""
-                    SELECT SUM(converted_amount) FROM expenses WHERE user_id = $1
-                """, str(user_id))
+                result = await self._run(conn, "fetchval", "get_total_spent", str(user_id))
         return result if result else 0
 
-    async def get_breakdown(self, user_id, location=None, requires_id=False):
-        """Get total spent per description, grouped by location, with original currency values."""
-        async with self.db.acquire() as conn:
-            columns = "id, location, amount, currency, converted_amount, timestamp" if requires_id else "location, amount, currency, converted_amount, timestamp"
+    @staticmethod
+    def _expense_filters(user_id, location=None, period=None, time_column="timestamp"):
+        """
+        Build the WHERE clause (and its arguments) for a user's expenses, optionally by location and period.
+        Use time_column="month" to filter the expense_totals rollup instead of expenses.
+        """
+        conditions = ["user_id = $1"]
+        args = [str(user_id)]
+        if location:
+            args.append(location)
+            conditions.append(f"location_key = LOWER(${len(args)})")
+        if period:
+            args.extend(period_bounds(period))
+            conditions.append(f"{time_column} >= ${len(args) - 1} AND {time_column} < ${len(args)}")
+        return " AND ".join(conditions), args
 
-            if location:
-                query = f"""
-                    SELECT {columns}
+    async def get_period_totals(self, user_id, group_by, location=None, currency=None):
+        """Get total spent per year ('yyyy') or month ('mm/yy') in chronological order, and the grand total."""
+        period = f"date_trunc('{self.GROUP_BY_TRUNC[group_by]}', month::TIMESTAMP)"
+        where, args = self._expense_filters(user_id, location)
+        total = await self._sum_total(currency, args)
+        async with self.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT {period} AS period, {total} AS total, GROUPING({period}) AS is_grand_total
+                FROM expense_totals
+                WHERE {where}
+                GROUP BY ROLLUP ({period})
+                ORDER BY is_grand_total, period
+            """, *args)
+
+        totals = [(row["period"], row["total"]) for row in rows if not row["is_grand_total"]]
+        grand_total = next((row["total"] for row in rows if row["is_grand_total"]), None)
+        return totals, grand_total if grand_total else 0
+
+    async def get_location_totals(self, user_id, period, location=None, currency=None):
+        """Get total spent per location within a specific year or month/year, and the grand total."""
+        where, args = self._expense_filters(user_id, location, period, time_column="month")
+        total = await self._sum_total(currency, args)
+        async with self.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT location_key AS location, {total} AS total,
+                       GROUPING(location_key) AS is_grand_total
+                FROM expense_totals
+                WHERE {where}
+                GROUP BY ROLLUP (location_key)
+                ORDER BY is_grand_total, location
+            """, *args)
+
+        totals = [(row["location"], row["total"]) for row in rows if not row["is_grand_total"]]
+        grand_total = next((row["total"] for row in rows if row["is_grand_total"]), None)
+        return totals, grand_total if grand_total else 0
+
+    async def get_expenses_page(self, user_id, location=None, period=None, group_by=None, after=None, limit=50,
+                                search=None):
+        """
+        Get up to `limit` expenses (as Expense) ordered by (year/month if group_by,) location, time and id, starting after the
+        `after` sort key. Keyset pagination keeps every page an index range scan, however deep the user pages.
+        With `search`, only expenses whose description matches it are returned (with their descriptions): as full-text
+        search terms, or fuzzily as a misspelled word. Both are served by GIN indexes.
+        """
+        where, args = self._expense_filters(user_id, location, period)
+        if search:
+            args.append(search)
+            where += f" AND (search_vector @@ websearch_to_tsquery('simple', ${len(args)}) OR ${len(args)} <% description)"
+        period_column = f"date_trunc('{self.GROUP_BY_TRUNC[group_by]}', timestamp)" if group_by else "NULL::TIMESTAMP"
+        sort_columns = ([period_column] if group_by else []) + ["location_key", "timestamp", "id"]
+        if after:
+            placeholders = ", ".join(f"${len(args) + i}" for i in range(1, len(after) + 1))
+            args.extend(after)
+            where += f" AND ({', '.join(sort_columns)}) > ({placeholders})"
+        args.append(limit)
+        async with self.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT id, location_key AS location, amount, currency, converted_amount, timestamp,
+                       {period_column} AS period{", description" if search else ""}
+                FROM expenses
+                WHERE {where}
+                ORDER BY {', '.join(sort_columns)}
+                LIMIT ${len(args)}
+            """, *args)
+
+        return [Expense.from_record(row) for row in rows]
+
+    async def iter_expense_batches(self, user_id, location=None, period=None):
+        """Yield a user's expenses in chronological order, EXPORT_BATCH_SIZE rows at a time, through a server-side cursor."""
+        where, args = self._expense_filters(user_id, location, period)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(f"""
+                    SELECT id, amount, currency, converted_amount, description, location_key AS location, timestamp
                     FROM expenses
-                    WHERE user_id = $1 AND LOWER(location) = LOWER($2)
-                    ORDER BY location
-                """
-                rows = await conn.fetch(query, str(user_id), location)
-            else:
-                query = f"""
-                    SELECT {columns}
+                    WHERE {where}
+                    ORDER BY timestamp, id
+                """, *args)
+                while batch := await cursor.fetch(self.EXPORT_BATCH_SIZE):
+                    yield batch
+
+    async def get_group_totals(self, user_id, group_by=None, by_location=False, location=None, period=None,
+                               currency=None):
+        """
+        Get total spent per group, keyed by a tuple of the grouping values - the year/month (if group_by) and the
+        location (if by_location). Without any grouping the single key is the empty tuple.
+        """
+        group_columns = ([f"date_trunc('{self.GROUP_BY_TRUNC[group_by]}', month::TIMESTAMP)"] if group_by else []) + \
+                        (["location_key"] if by_location else [])
+        where, args = self._expense_filters(user_id, location, period, time_column="month")
+        total = await self._sum_total(currency, args)
+        select = "".join(f"{column} AS group_{i}, " for i, column in enumerate(group_columns))
+        group_clause = f"GROUP BY {', '.join(group_columns)}" if group_columns else ""
+        async with self.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT {select}{total} AS total
+                FROM expense_totals
+                WHERE {where}
+                {group_clause}
+            """, *args)
+
+        return {tuple(row[f"group_{i}"] for i in range(len(group_columns))): row["total"] or 0 for row in rows}
+
+    async def rebuild_expense_totals(self, user_id=None):
+        """
+        Reconcile the expense_totals rollup and budget spend from the raw expenses, for one user or everyone, dropping
+        whatever was cached from the old totals.
+        """
+        where, args = ("WHERE user_id = $1", [str(user_id)]) if user_id is not None else ("", [])
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                # Block concurrent writes so the rebuilt rollup matches the expenses exactly.
+                await conn.execute("LOCK TABLE expenses IN SHARE MODE")
+                await conn.execute(f"DELETE FROM expense_totals {where}", *args)
+                result = await conn.execute(f"""
+                    INSERT INTO expense_totals (user_id, location_key, month, currency, total, original_total, count)
+                    SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, currency, SUM(converted_amount),
+                           SUM(amount), COUNT(*)
                     FROM expenses
-                    WHERE user_id = $1
-                    ORDER BY location
-                """
-                rows = await conn.fetch(query, str(user_id))
+                    {where}
+                    GROUP BY 1, 2, 3, 4
+                """, *args)
+                await conn.execute(f"""
+                    UPDATE budgets AS b SET spent = COALESCE((
+                        SELECT SUM(converted_amount) FROM expenses e
+                        WHERE e.user_id = b.user_id AND b.location_key IN ('', e.location_key)
+                              AND (b.period_start IS NULL OR (e.timestamp >= b.period_start AND e.timestamp < b.period_end))
+                    ), 0)
+                    {where}
+                """, *args)
+        if user_id is not None:
+            self._expenses_changed(user_id)
+        else:
+            self._invalidate_all()
+            self._publish("all")
+        return int(result.split()[-1])
 
-        breakdown = {}
-        for row in rows:
-            loc = row["location"].lower()
-            if loc not in breakdown:
-                breakdown[loc] = []
-            expense = {
-                "amount": row["converted_amount"],
-                "original_amount": row["amount"],
-                "currency": row["currency"],
-                "timestamp": row["timestamp"]
-            }
-            if requires_id:
-                expense['id'] = row['id']
-            breakdown[loc].append(expense)
-
-        return breakdown
+    async def set_budget(self, user_id, amount, location=None, period=None):
+        """
+        Set the user's budget (in the base currency) for a location and/or a year or month/year period, returning it
+        with what was already spent within it. Thresholds the spend has already reached are not alerted.
+        """
+        period_start, period_end = period_bounds(period) if period else (None, None)
+        where, args = self._expense_filters(user_id, location, period, time_column="month")
+        args.extend([location or "", period or "", period_start, period_end, amount, self.BUDGET_THRESHOLDS])
+        n = len(args)
+        async with self.acquire() as conn:
+            return await conn.fetchrow(f"""
+                WITH current AS (
+                    SELECT COALESCE(SUM(total), 0) AS spent FROM expense_totals WHERE {where}
+                )
+                INSERT INTO budgets (user_id, location_key, period, period_start, period_end, amount, spent,
+                                     alerted_percent)
+                SELECT $1, ${n - 5}, ${n - 4}, ${n - 3}, ${n - 2}, ${n - 1}::NUMERIC, spent,
+                       COALESCE((SELECT MAX(threshold) FROM unnest(${n}::INTEGER[]) AS threshold
+                                 WHERE spent * 100 >= ${n - 1}::NUMERIC * threshold), 0)
+                FROM current
+                ON CONFLICT (user_id, location_key, period) DO UPDATE
+                SET amount = EXCLUDED.amount, spent = EXCLUDED.spent, alerted_percent = EXCLUDED.alerted_percent
+                RETURNING location_key, period, amount, spent
+            """, *args)
+
+    async def delete_budget(self, user_id, location=None, period=None) -> bool:
+        async with self.acquire() as conn:
+            deleted_id = await conn.fetchval("""
+                DELETE FROM budgets WHERE user_id = $1 AND location_key = $2 AND period = $3 RETURNING id
+            """, str(user_id), location or "", period or "")
+        return deleted_id is not None
+
+    async def create_trip(self, user_id, name):
+        """Create a trip with the user as its first member, returning its id, or None if the name is taken."""
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                trip_id = await conn.fetchval("""
+                    INSERT INTO trips (name, created_by) VALUES ($1, $2) ON CONFLICT (name_key) DO NOTHING RETURNING id
+                """, name, str(user_id))
+                if trip_id is not None:
+                    await conn.execute("INSERT INTO trip_members (trip_id, user_id) VALUES ($1, $2)", trip_id,
+                                       str(user_id))
+        return trip_id
+
+    async def join_trip(self, user_id, name):
+        """Add the user to the trip named `name` (if not a member already), returning the trip or None if not found."""
+        async with self.acquire() as conn:
+            return await conn.fetchrow("""
+                WITH trip AS (
+                    SELECT id, name FROM trips WHERE name_key = LOWER($1)
+                ), joined AS (
+                    INSERT INTO trip_members (trip_id, user_id) SELECT id, $2 FROM trip ON CONFLICT DO NOTHING
+                )
+                SELECT id, name FROM trip
+            """, name, str(user_id))
+
+    async def get_trip(self, user_id, name):
+        """The trip named `name`, or None if there is none or the user isn't one of its members."""
+        async with self.acquire() as conn:
+            return await conn.fetchrow("""
+                SELECT t.id, t.name FROM trips t
+                JOIN trip_members m ON m.trip_id = t.id AND m.user_id = $2
+                WHERE t.name_key = LOWER($1)
+            """, name, str(user_id))
+
+    async def get_trip_balances(self, trip_id) -> dict:
+        """Every member's net balance in the base currency: positive if they are owed money, negative if they owe."""
+        async with self.acquire() as conn:
+            rows = await conn.fetch("SELECT user_id, balance FROM trip_members WHERE trip_id = $1", trip_id)
+        return {row["user_id"]: row["balance"] for row in rows}
+
+    async def get_budgets(self, user_id):
+        async with self.acquire() as conn:
+            return await conn.fetch("""
+                SELECT location_key, period, amount, spent FROM budgets
+                WHERE user_id = $1
+                ORDER BY period_start NULLS FIRST, location_key
+            """, str(user_id))
+
+    def queue_budget_check(self, user_id):
+        """Have the user's budget thresholds checked in the background, unless they are already waiting to be."""
+        if str(user_id) not in self.pending_budget_checks:
+            self.pending_budget_checks.add(str(user_id))
+            self.budget_checks.put_nowait(str(user_id))
+
+    async def next_budget_check(self) -> str:
+        """Wait for the next user whose expenses changed since their budget thresholds were last checked."""
+        user_id = await self.budget_checks.get()
+        self.pending_budget_checks.discard(user_id)
+        return user_id
+
+    async def check_budget_thresholds(self, user_id):
+        """
+        Get the user's budgets whose spend reached a different alert threshold (`percent`) than the one last recorded
+        (`previous_percent`). Nothing is recorded here, so an alert that fails to be delivered can be retried.
+        """
+        async with self.acquire() as conn:
+            return await self._run(conn, "fetch", "check_budget_thresholds", str(user_id), self.BUDGET_THRESHOLDS)
+
+    async def record_budget_alert(self, budget):
+        """Record the threshold a budget (as returned by check_budget_thresholds) reached as alerted."""
+        async with self.acquire() as conn:
+            await self._run(conn, "execute", "record_budget_alert", budget["id"], budget["percent"],
+                            budget["previous_percent"])
 
     async def set_location(self, user_id, location):
-        async with self.db.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO user_locations (user_id, location)
-                VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET location = EXCLUDED.location
-            """, str(user_id), location)
+        async with self.acquire() as conn:
+            await self._run(conn, "execute", "set_location", str(user_id), location)
+        self._apply_location(str(user_id), location)
+        self._publish("location", user_id, location=location)
 
     async def get_location(self, user_id):
-        async with self.db.acquire() as conn:
-            result = await conn.fetchval("""
-                SELECT location FROM user_locations WHERE user_id = $1
-            """, str(user_id))
+        if str(user_id) in self.location_cache:
+            return self.location_cache[str(user_id)]
+        async with self.acquire() as conn:
+            result = await self._run(conn, "fetchval", "get_location", str(user_id))
+        if result:
+            self.location_cache[str(user_id)] = result
         return result
 
-    def load_valid_currencies(self):
-        response = requests.get(f"https://v6.exchangerate-api.com/v6/{config.EXCHANGE_API_KEY}/codes")
-        data = response.json()
-        return {code for code, _ in data.get("supported_codes", [])}
+    async def set_currency(self, user_id, currency):
+        async with self.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO user_currencies (user_id, currency)
+                VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET currency = EXCLUDED.currency
+            """, str(user_id), currency)
+        self._apply_currency(str(user_id), currency)
+        self._publish("currency", user_id)
+
+    async def get_currency(self, user_id):
+        """The currency the user's reports are shown in, the base currency unless they chose another one."""
+        if str(user_id) not in self.currency_cache:
+            async with self.acquire() as conn:
+                result = await conn.fetchval("SELECT currency FROM user_currencies WHERE user_id = $1", str(user_id))
+            self.currency_cache[str(user_id)] = result or self.BASE_CURRENCY
+        return self.currency_cache[str(user_id)]
+
+    async def load_location_index(self):
+        """Index every user's locations (those of their expenses and their current one) for autocomplete."""
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT DISTINCT user_id, location_key FROM expense_totals
+                UNION
+                SELECT user_id, LOWER(location) FROM user_locations
+            """)
+        locations = defaultdict(list)
+        for row in rows:
+            locations[row["user_id"]].append(row["location_key"])
+        self.location_index = defaultdict(PrefixIndex, {user_id: PrefixIndex(user_locations)
+                                                        for user_id, user_locations in locations.items()})
+        return len(rows)
+
+    def search_locations(self, user_id, prefix, limit=25):
+        return self.location_index[str(user_id)].search(prefix, limit) if str(user_id) in self.location_index else []
+
+    def search_currencies(self, prefix, limit=25):
+        return self.currency_index.search(prefix, limit)
+
+    async def load_valid_currencies(self):
+        """Load the supported currency codes from the local snapshot."""
+        async with self.acquire() as conn:
+            rows = await conn.fetch("SELECT code FROM currencies")
+        self.VALID_CURRENCIES = {row["code"] for row in rows}
+        self.currency_index = PrefixIndex(self.VALID_CURRENCIES)
+        return self.VALID_CURRENCIES
+
+    async def refresh_valid_currencies(self):
+        """Fetch the supported currency codes from the exchange rate API and update the local snapshot."""
+        try:
+            supported_codes = await self.rates.get_supported_codes()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"Failed to refresh supported currencies, keeping {len(self.VALID_CURRENCIES)} known codes: {e!r}")
+            return self.VALID_CURRENCIES
+        if not supported_codes:
+            return self.VALID_CURRENCIES
+
+        async with self.acquire() as conn:
+            await conn.executemany("""
+                INSERT INTO currencies (code, name)
+                VALUES ($1, $2) ON CONFLICT (code) DO UPDATE SET name = EXCLUDED.name, updated_at = CURRENT_TIMESTAMP
+            """, [(code, name) for code, name in supported_codes])
+        self.VALID_CURRENCIES = {code for code, _ in supported_codes}
+        self.currency_index = PrefixIndex(self.VALID_CURRENCIES)
+        logger.info(f"Refreshed {len(self.VALID_CURRENCIES)} supported currencies")
+        return self.VALID_CURRENCIES
+
+    async def refresh_valid_currencies_periodically(self):
+        while True:
+            await asyncio.sleep(config.CURRENCY_REFRESH_INTERVAL)
+            await self.refresh_valid_currencies()
 
     async def get_expense_by_id(self, user_id: str, expense_id: int):
-        async with self.db.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT * FROM expenses WHERE id = $1 and user_id = $2
-            """, int(expense_id), str(user_id))
+        async with self.acquire() as conn:
+            row = await self._run(conn, "fetchrow", "get_expense_by_id", int(expense_id), str(user_id))
 
         return row
 
     async def delete_expense(self, user_id: str, expense_id: int) -> bool:
-        async with self.db.acquire() as conn:
-            # Validate ownership and existence.
-            expense = await conn.fetchval("""
-                SELECT * FROM expenses 
-                WHERE id = $1 AND user_id = $2
-            """, int(expense_id), str(user_id))
-            if not expense:
-                return False
-            # Delete the expense.
-            await conn.execute("""
-                DELETE FROM expenses 
-                WHERE id = $1 AND user_id = $2
-            """, int(expense_id), str(user_id))
-        return True
+        # Ownership and existence are part of the predicate, so deleting nothing means there was nothing to delete.
+        async with self.acquire() as conn:
+            deleted_id = await self._run(conn, "fetchval", "delete_expense", int(expense_id), str(user_id))
+        if deleted_id is not None:
+            self._expenses_changed(user_id)
+        return deleted_id is not None
 
 
 db = Database()
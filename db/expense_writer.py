@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import os
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from datetime import datetime
+
+import aiohttp
+import asyncpg
+
+from db.database import db, Database
+from utils import config
+from utils.common_funcs import utc_now
+
+logger = logging.getLogger(__name__)
+
+# Failures worth retrying: the db or the exchange rate API being unreachable, overloaded or restarting.
+TRANSIENT_ERRORS = (OSError, asyncio.TimeoutError, aiohttp.ClientError, asyncpg.InterfaceError,
+                    asyncpg.PostgresConnectionError, asyncpg.InsufficientResourcesError,
+                    asyncpg.OperatorInterventionError, asyncpg.TransactionRollbackError)
+
+
+@dataclass(slots=True)
+class QueuedExpense:
+    """An expense waiting to be written; `notify(message)` reports a failure to write it back to the user."""
+    user_id: str
+    amount: float
+    currency: str
+    description: str
+    location: str
+    timestamp: datetime
+    notify: Callable[[str], Awaitable] | None = None
+
+    def to_row(self):
+        return self.user_id, self.amount, self.currency, self.description, self.location, self.timestamp
+
+
+class ExpenseWriter:
+    """
+    Write-behind queue for /spent: expenses are validated and queued right away, and a background worker inserts
+    whatever has queued up in batches. Transient failures are retried with exponential backoff; a batch that keeps
+    failing, and anything still queued at shutdown, is spooled to a JSON Lines file that is written on the next start.
+    """
+
+    def __init__(self, database: Database, max_queued: int = None, batch_size: int = None, spool_file: str = None):
+        self.db = database
+        self.queue = asyncio.Queue(maxsize=config.SPENT_QUEUE_SIZE if max_queued is None else max_queued)
+        self.batch_size = config.SPENT_BATCH_SIZE if batch_size is None else batch_size
+        self.spool_file = config.SPENT_SPOOL_FILE if spool_file is None else spool_file
+        self.MAX_ATTEMPTS = 5
+        self.RETRY_DELAY = 1.0
+        self.FLUSH_TIMEOUT = 30.0
+        self.closing = False
+
+    async def submit(self, user_id, amount, currency, description, notify=None):
+        """
+        Validate and queue an expense at the user's current location. Returns True once queued, None if the user has
+        no location set, or False if the currency is not supported. Raises asyncio.QueueFull if the queue is full
+        or shutting down, in which case the expense should be written directly.
+        """
+        if self.closing:
+            raise asyncio.QueueFull
+        if currency.upper() not in self.db.VALID_CURRENCIES:
+            return False
+        location = await self.db.get_location(user_id)
+        if not location:
+            return None
+        self.queue.put_nowait(QueuedExpense(str(user_id), amount, currency.upper(), description, location,
+                                            utc_now(), notify))
+        return True
+
+    async def run(self):
+        """Write queued expenses until cancelled, a batch of up to batch_size of them at a time."""
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self._write(batch)
+            except asyncio.CancelledError:
+                self._spool(batch)
+                raise
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _write(self, batch):
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            try:
+                await self.db.add_expenses([expense.to_row() for expense in batch])
+                return
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.MAX_ATTEMPTS:
+                    logger.error(f"Failed to write {len(batch)} queued expenses after {attempt} attempts, spooling "
+                                 f"them to {self.spool_file}: {e!r}")
+                    self._spool(batch)
+                    await self._notify(batch, "⚠️ Your expense of {amount} {currency} for {description} couldn't be "
+                                              "saved yet. It will be saved once the bot restarts.")
+                    return
+                logger.warning(f"Failed to write {len(batch)} queued expenses (attempt {attempt}), retrying: {e!r}")
+                await asyncio.sleep(self.RETRY_DELAY * 2 ** (attempt - 1))
+            except (asyncpg.PostgresError, KeyError, ValueError) as e:
+                if len(batch) > 1:
+                    # Write the expenses one by one, so only the invalid ones are rejected.
+                    for expense in batch:
+                        await self._write([expense])
+                    return
+                logger.error(f"Failed to write queued expense {batch[0].to_row()}: {e!r}")
+                await self._notify(batch, "❌ Your expense of {amount} {currency} for {description} couldn't be saved.")
+                return
+
+    @staticmethod
+    async def _notify(batch, message):
+        for expense in batch:
+            if expense.notify is None:
+                continue
+            try:
+                await expense.notify(message.format(amount=expense.amount, currency=expense.currency,
+                                                    description=expense.description))
+            except Exception as e:
+                logger.warning(f"Failed to notify {expense.user_id} about a queued expense: {e!r}")
+
+    def _spool(self, batch):
+        if not batch:
+            return
+        with open(self.spool_file, "a", encoding="utf-8") as spool:
+            for expense in batch:
+                spool.write(json.dumps({"user_id": expense.user_id, "amount": expense.amount,
+                                        "currency": expense.currency, "description": expense.description,
+                                        "location": expense.location, "timestamp": expense.timestamp.isoformat()})
+                            + "\n")
+
+    async def recover(self):
+        """Write the expenses spooled by a previous run, keeping the spool file if that fails."""
+        if not os.path.exists(self.spool_file):
+            return 0
+        with open(self.spool_file, encoding="utf-8") as spool:
+            rows = [json.loads(line) for line in spool if line.strip()]
+        try:
+            await self.db.add_expenses([(row["user_id"], row["amount"], row["currency"], row["description"],
+                                         row["location"], datetime.fromisoformat(row["timestamp"])) for row in rows])
+        except TRANSIENT_ERRORS + (asyncpg.PostgresError, KeyError, ValueError) as e:
+            logger.error(f"Failed to recover {len(rows)} spooled expenses, keeping {self.spool_file}: {e!r}")
+            return 0
+        os.remove(self.spool_file)
+        logger.info(f"Recovered {len(rows)} spooled expenses from {self.spool_file}")
+        return len(rows)
+
+    async def close(self):
+        """Stop accepting expenses and wait for the queued ones to be written, spooling what's left on timeout."""
+        self.closing = True
+        try:
+            await asyncio.wait_for(self.queue.join(), self.FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            remaining = []
+            while not self.queue.empty():
+                remaining.append(self.queue.get_nowait())
+                self.queue.task_done()
+            logger.warning(f"Timed out flushing queued expenses, spooling {len(remaining)} to {self.spool_file}")
+            # The batch being written (if any) is spooled by the worker when db.close() cancels it.
+            self._spool(remaining)
+
+
+expense_writer = ExpenseWriter(db)
@@ -0,0 +1,325 @@
+# Schema migrations, applied in order by Database.create_tables.
+# A migration's version is its position in the list (starting at 1) - only ever append new entries.
+MIGRATIONS = [
+    # 1: Initial schema.
+    """
+    CREATE TABLE IF NOT EXISTS expenses (
+        id SERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        amount NUMERIC(10, 2) NOT NULL,
+        currency TEXT NOT NULL,
+        converted_amount NUMERIC(10, 2) NOT NULL,
+        description TEXT NOT NULL,
+        location TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS user_locations (
+        user_id TEXT PRIMARY KEY,
+        location TEXT NOT NULL
+    );
+    """,
+    # 2: Normalized (lowercase) location column, and indexes for per-user location and period lookups.
+    """
+    ALTER TABLE expenses ADD COLUMN IF NOT EXISTS location_key TEXT GENERATED ALWAYS AS (LOWER(location)) STORED;
+
+    CREATE INDEX IF NOT EXISTS expenses_user_location_timestamp_idx ON expenses (user_id, location_key, timestamp);
+    CREATE INDEX IF NOT EXISTS expenses_user_timestamp_idx ON expenses (user_id, timestamp);
+    """,
+    # 3: Snapshot of the exchange rate API's supported currency codes, so cold starts don't depend on the API.
+    """
+    CREATE TABLE IF NOT EXISTS currencies (
+        code TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    # 4: Exchange rate history, populated by the periodic rate fetcher and consulted before the live API.
+    """
+    CREATE TABLE IF NOT EXISTS exchange_rates (
+        date DATE NOT NULL,
+        from_currency TEXT NOT NULL,
+        to_currency TEXT NOT NULL,
+        rate NUMERIC NOT NULL,
+        PRIMARY KEY (date, from_currency, to_currency)
+    );
+
+    CREATE INDEX IF NOT EXISTS exchange_rates_pair_date_idx ON exchange_rates (from_currency, to_currency, date);
+    """,
+    # 5: Per user/location/month rollup of expenses, kept current by statement-level triggers on expenses.
+    """
+    CREATE TABLE IF NOT EXISTS expense_totals (
+        user_id TEXT NOT NULL,
+        location_key TEXT NOT NULL,
+        month DATE NOT NULL,
+        total NUMERIC NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, location_key, month)
+    );
+
+    CREATE OR REPLACE FUNCTION apply_expense_totals() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO expense_totals AS t (user_id, location_key, month, total, count)
+            SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, -SUM(converted_amount), -COUNT(*)
+            FROM old_rows
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, location_key, month)
+            DO UPDATE SET total = t.total + EXCLUDED.total, count = t.count + EXCLUDED.count;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'INSERT') THEN
+            INSERT INTO expense_totals AS t (user_id, location_key, month, total, count)
+            SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, SUM(converted_amount), COUNT(*)
+            FROM new_rows
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, location_key, month)
+            DO UPDATE SET total = t.total + EXCLUDED.total, count = t.count + EXCLUDED.count;
+        END IF;
+        DELETE FROM expense_totals WHERE count = 0;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS expense_totals_insert ON expenses;
+    CREATE TRIGGER expense_totals_insert AFTER INSERT ON expenses
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_expense_totals();
+    DROP TRIGGER IF EXISTS expense_totals_update ON expenses;
+    CREATE TRIGGER expense_totals_update AFTER UPDATE ON expenses
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_expense_totals();
+    DROP TRIGGER IF EXISTS expense_totals_delete ON expenses;
+    CREATE TRIGGER expense_totals_delete AFTER DELETE ON expenses
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_expense_totals();
+
+    INSERT INTO expense_totals (user_id, location_key, month, total, count)
+    SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, SUM(converted_amount), COUNT(*)
+    FROM expenses
+    GROUP BY 1, 2, 3
+    ON CONFLICT (user_id, location_key, month) DO NOTHING;
+    """,
+    # 6: Budgets per user, optionally limited to a location ('' for all) and a year or month/year period ('' for all
+    #    time). The spend within each budget is kept current by statement-level triggers on expenses, like
+    #    expense_totals, and alerted_percent is the highest alert threshold already reported.
+    """
+    CREATE TABLE IF NOT EXISTS budgets (
+        id SERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        location_key TEXT NOT NULL DEFAULT '',
+        period TEXT NOT NULL DEFAULT '',
+        period_start TIMESTAMP,
+        period_end TIMESTAMP,
+        amount NUMERIC(10, 2) NOT NULL,
+        spent NUMERIC NOT NULL DEFAULT 0,
+        alerted_percent INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (user_id, location_key, period)
+    );
+
+    CREATE OR REPLACE FUNCTION apply_budget_spent() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE budgets AS b SET spent = b.spent - d.total
+            FROM (
+                SELECT budgets.id, SUM(r.converted_amount) AS total
+                FROM old_rows r
+                JOIN budgets ON budgets.user_id = r.user_id
+                    AND budgets.location_key IN ('', r.location_key)
+                    AND (budgets.period_start IS NULL
+                         OR (r.timestamp >= budgets.period_start AND r.timestamp < budgets.period_end))
+                GROUP BY budgets.id
+            ) d
+            WHERE b.id = d.id;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'INSERT') THEN
+            UPDATE budgets AS b SET spent = b.spent + d.total
+            FROM (
+                SELECT budgets.id, SUM(r.converted_amount) AS total
+                FROM new_rows r
+                JOIN budgets ON budgets.user_id = r.user_id
+                    AND budgets.location_key IN ('', r.location_key)
+                    AND (budgets.period_start IS NULL
+                         OR (r.timestamp >= budgets.period_start AND r.timestamp < budgets.period_end))
+                GROUP BY budgets.id
+            ) d
+            WHERE b.id = d.id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS budget_spent_insert ON expenses;
+    CREATE TRIGGER budget_spent_insert AFTER INSERT ON expenses
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_budget_spent();
+    DROP TRIGGER IF EXISTS budget_spent_update ON expenses;
+    CREATE TRIGGER budget_spent_update AFTER UPDATE ON expenses
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_budget_spent();
+    DROP TRIGGER IF EXISTS budget_spent_delete ON expenses;
+    CREATE TRIGGER budget_spent_delete AFTER DELETE ON expenses
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_budget_spent();
+    """,
+    # 7: Per-user home currency for reports, and a currency dimension (with the original amounts) in the
+    #    expense_totals rollup, so totals can be converted to any currency per currency bucket.
+    """
+    CREATE TABLE IF NOT EXISTS user_currencies (
+        user_id TEXT PRIMARY KEY,
+        currency TEXT NOT NULL
+    );
+
+    ALTER TABLE expense_totals ADD COLUMN IF NOT EXISTS currency TEXT NOT NULL DEFAULT '';
+    ALTER TABLE expense_totals ADD COLUMN IF NOT EXISTS original_total NUMERIC NOT NULL DEFAULT 0;
+    ALTER TABLE expense_totals ALTER COLUMN currency DROP DEFAULT;
+    ALTER TABLE expense_totals DROP CONSTRAINT IF EXISTS expense_totals_pkey;
+    TRUNCATE expense_totals;
+    INSERT INTO expense_totals (user_id, location_key, month, currency, total, original_total, count)
+    SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, currency, SUM(converted_amount), SUM(amount),
+           COUNT(*)
+    FROM expenses
+    GROUP BY 1, 2, 3, 4;
+    ALTER TABLE expense_totals ADD PRIMARY KEY (user_id, location_key, month, currency);
+
+    CREATE OR REPLACE FUNCTION apply_expense_totals() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO expense_totals AS t (user_id, location_key, month, currency, total, original_total, count)
+            SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, currency, -SUM(converted_amount),
+                   -SUM(amount), -COUNT(*)
+            FROM old_rows
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (user_id, location_key, month, currency)
+            DO UPDATE SET total = t.total + EXCLUDED.total, original_total = t.original_total + EXCLUDED.original_total,
+                          count = t.count + EXCLUDED.count;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'INSERT') THEN
+            INSERT INTO expense_totals AS t (user_id, location_key, month, currency, total, original_total, count)
+            SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, currency, SUM(converted_amount),
+                   SUM(amount), COUNT(*)
+            FROM new_rows
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (user_id, location_key, month, currency)
+            DO UPDATE SET total = t.total + EXCLUDED.total, original_total = t.original_total + EXCLUDED.original_total,
+                          count = t.count + EXCLUDED.count;
+        END IF;
+        DELETE FROM expense_totals WHERE count = 0;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    # 8: Trips shared by several users, with expenses split between their members. Each member's net balance (what
+    #    they are owed, negative if they owe) is kept current by statement-level triggers on expense_splits, which
+    #    records the payer and trip of every share so a cascading delete of the expense can still reverse it.
+    """
+    CREATE TABLE IF NOT EXISTS trips (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        name_key TEXT GENERATED ALWAYS AS (LOWER(name)) STORED UNIQUE,
+        created_by TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS trip_members (
+        trip_id INTEGER NOT NULL REFERENCES trips (id) ON DELETE CASCADE,
+        user_id TEXT NOT NULL,
+        balance NUMERIC NOT NULL DEFAULT 0,
+        PRIMARY KEY (trip_id, user_id)
+    );
+
+    CREATE INDEX IF NOT EXISTS trip_members_user_idx ON trip_members (user_id);
+
+    CREATE TABLE IF NOT EXISTS expense_splits (
+        expense_id INTEGER NOT NULL REFERENCES expenses (id) ON DELETE CASCADE,
+        trip_id INTEGER NOT NULL,
+        payer_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        share NUMERIC(10, 2) NOT NULL,
+        PRIMARY KEY (expense_id, user_id),
+        FOREIGN KEY (trip_id, payer_id) REFERENCES trip_members (trip_id, user_id),
+        FOREIGN KEY (trip_id, user_id) REFERENCES trip_members (trip_id, user_id)
+    );
+
+    CREATE OR REPLACE FUNCTION apply_trip_balances() RETURNS TRIGGER AS $$
+    BEGIN
+        -- The payer is owed each share, and the member it was split to owes it.
+        IF TG_OP = 'INSERT' THEN
+            UPDATE trip_members AS m SET balance = m.balance + d.delta
+            FROM (
+                SELECT trip_id, user_id, SUM(delta) AS delta
+                FROM (
+                    SELECT trip_id, payer_id AS user_id, share AS delta FROM new_rows
+                    UNION ALL
+                    SELECT trip_id, user_id, -share FROM new_rows
+                ) deltas
+                GROUP BY trip_id, user_id
+            ) d
+            WHERE m.trip_id = d.trip_id AND m.user_id = d.user_id;
+        ELSE
+            UPDATE trip_members AS m SET balance = m.balance + d.delta
+            FROM (
+                SELECT trip_id, user_id, SUM(delta) AS delta
+                FROM (
+                    SELECT trip_id, payer_id AS user_id, -share AS delta FROM old_rows
+                    UNION ALL
+                    SELECT trip_id, user_id, share FROM old_rows
+                ) deltas
+                GROUP BY trip_id, user_id
+            ) d
+            WHERE m.trip_id = d.trip_id AND m.user_id = d.user_id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS trip_balances_insert ON expense_splits;
+    CREATE TRIGGER trip_balances_insert AFTER INSERT ON expense_splits
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_trip_balances();
+    DROP TRIGGER IF EXISTS trip_balances_delete ON expense_splits;
+    CREATE TRIGGER trip_balances_delete AFTER DELETE ON expense_splits
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_trip_balances();
+    """,
+    # 9: Full-text search over expense descriptions, with a trigram index for fuzzy (misspelled) matches.
+    """
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+    ALTER TABLE expenses ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+        GENERATED ALWAYS AS (to_tsvector('simple', description)) STORED;
+
+    CREATE INDEX IF NOT EXISTS expenses_search_vector_idx ON expenses USING GIN (search_vector);
+    CREATE INDEX IF NOT EXISTS expenses_description_trgm_idx ON expenses USING GIN (description gin_trgm_ops);
+    """,
+    # 10: Only look for emptied rollup rows among the ones the statement subtracted from, instead of scanning the
+    #     whole rollup on every write.
+    """
+    CREATE OR REPLACE FUNCTION apply_expense_totals() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO expense_totals AS t (user_id, location_key, month, currency, total, original_total, count)
+            SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, currency, -SUM(converted_amount),
+                   -SUM(amount), -COUNT(*)
+            FROM old_rows
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (user_id, location_key, month, currency)
+            DO UPDATE SET total = t.total + EXCLUDED.total, original_total = t.original_total + EXCLUDED.original_total,
+                          count = t.count + EXCLUDED.count;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'INSERT') THEN
+            INSERT INTO expense_totals AS t (user_id, location_key, month, currency, total, original_total, count)
+            SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, currency, SUM(converted_amount),
+                   SUM(amount), COUNT(*)
+            FROM new_rows
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (user_id, location_key, month, currency)
+            DO UPDATE SET total = t.total + EXCLUDED.total, original_total = t.original_total + EXCLUDED.original_total,
+                          count = t.count + EXCLUDED.count;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM expense_totals
+            WHERE (user_id, location_key, month, currency) IN (
+                SELECT user_id, location_key, date_trunc('month', timestamp)::DATE, currency FROM old_rows
+            ) AND count = 0;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    # 11: Default expense timestamps to UTC (like the ones the bot assigns itself) instead of the db's time zone.
+    """
+    ALTER TABLE expenses ALTER COLUMN timestamp SET DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC');
+    """,
+]
@@ -0,0 +1,28 @@
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+
+
+@dataclass(frozen=True, slots=True)
+class Expense:
+    """
+    An expense as listed by the breakdown and list commands, with `amount` converted to the base currency.
+    `period` is the start of its year/month when listed grouped by one, and `description` is only loaded by searches.
+    Immutable, so grouping can't alter it.
+    """
+    id: int | None
+    location: str
+    amount: Decimal
+    original_amount: Decimal
+    currency: str
+    timestamp: datetime
+    period: datetime | None = None
+    description: str | None = None
+
+    @classmethod
+    def from_record(cls, row):
+        """Build an expense from a row with the location, amount, currency, converted_amount and timestamp columns."""
+        # Interning shares one string per location/currency across every expense of a (large) listing.
+        return cls(row.get("id"), sys.intern(row["location"]), row["converted_amount"], row["amount"],
+                   sys.intern(row["currency"]), row["timestamp"], row.get("period"), row.get("description"))
@@ -0,0 +1,85 @@
+import asyncpg
+
+# Hot queries, prepared once per pooled connection by Database._init_connection and run by name.
+STATEMENTS = {
+    "add_expense": """
+        INSERT INTO expenses (user_id, amount, currency, converted_amount, description, location)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        RETURNING id
+    """,
+    "add_expense_at_current_location": """
+        INSERT INTO expenses (user_id, amount, currency, converted_amount, description, location)
+        SELECT $1, $2, $3, $4, $5, location FROM user_locations WHERE user_id = $1
+        RETURNING id, location
+    """,
+    "get_total_spent": """
+        SELECT SUM(total) FROM expense_totals WHERE user_id = $1
+    """,
+    "get_total_spent_at_location": """
+        SELECT SUM(total) FROM expense_totals WHERE user_id = $1 AND location_key = LOWER($2)
+    """,
+    "get_conversion_rate": """
+        SELECT date, rate FROM exchange_rates
+        WHERE from_currency = $1 AND to_currency = $2 AND date <= $3
+        ORDER BY date DESC LIMIT 1
+    """,
+    "set_location": """
+        INSERT INTO user_locations (user_id, location)
+        VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET location = EXCLUDED.location
+    """,
+    "get_location": """
+        SELECT location FROM user_locations WHERE user_id = $1
+    """,
+    "get_expense_by_id": """
+        SELECT id, user_id, amount, currency, converted_amount, description, location, timestamp
+        FROM expenses WHERE id = $1 AND user_id = $2
+    """,
+    "delete_expense": """
+        DELETE FROM expenses WHERE id = $1 AND user_id = $2 RETURNING id
+    """,
+    # Moves alerted_percent of the user's budgets to the highest threshold ($2) their spend has reached, returning
+    # the budgets whose threshold changed along with the previous one.
+    "check_budget_thresholds": """
+        SELECT id, location_key, period, amount, spent, percent, previous_percent
+        FROM (
+            SELECT id, location_key, period, amount, spent, alerted_percent AS previous_percent,
+                   COALESCE((SELECT MAX(threshold) FROM unnest($2::INTEGER[]) AS threshold
+                             WHERE spent * 100 >= amount * threshold), 0) AS percent
+            FROM budgets
+            WHERE user_id = $1
+        ) t
+        WHERE percent <> previous_percent
+    """,
+    "record_budget_alert": """
+        UPDATE budgets SET alerted_percent = $2 WHERE id = $1 AND alerted_percent = $3
+    """,
+}
+
+STATEMENT_NAMES = {query: name for name, query in STATEMENTS.items()}
+
+
+class Connection(asyncpg.Connection):
+    """
+    A pooled connection that keeps the statements from STATEMENTS prepared in its statement cache. This relies on
+    asyncpg internals (_get_statement and _stmt_cache, as of the asyncpg version pinned in requirements.txt); without
+    them statements are simply prepared on first use, and reported as cache misses.
+    """
+
+    async def prepare_registered(self, name):
+        # Unlike prepare(), this goes through asyncpg's statement cache, so every later fetch/execute of the same query
+        # text on this connection reuses the server-side prepared statement instead of parsing and planning it again.
+        # (A PreparedStatement object can't be kept instead: asyncpg invalidates it when the connection is released.)
+        if hasattr(self, "_get_statement") and self._cache_enabled():
+            await self._get_statement(STATEMENTS[name], None)
+
+    def _cache_enabled(self) -> bool:
+        cache = getattr(self, "_stmt_cache", None)
+        return cache is not None and bool(cache.get_max_size())
+
+    def is_cached(self, name) -> bool:
+        """Whether the statement is in the statement cache now, i.e. will run without being parsed and planned again."""
+        cache = getattr(self, "_stmt_cache", None)
+        if cache is None:
+            return False
+        # Keyed like Connection._get_statement does, for the default record class and codecs that fetch/execute use.
+        return cache.has((STATEMENTS[name], self._protocol.get_record_class(), False))
@@ -5,11 +5,20 @@ import discord
 from discord.ext import commands
 
 from commands.bot_commands import setup as setup_commands
+from commands.logic import deliver_budget_alerts
 from db.database import db
+from db.expense_writer import expense_writer
 from utils import config
+from utils.metrics import dump_traces
 
 intents = discord.Intents.default()
-bot = commands.Bot(command_prefix="!", intents=intents)
+if config.SHARD_COUNT or config.SHARD_IDS:
+    # Each process runs the shards in SHARD_IDS (all of them if unset, and then SHARD_COUNT defaults to Discord's
+    # recommendation) out of SHARD_COUNT; processes sharing the db should also set CACHE_SYNC.
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=config.SHARD_COUNT,
+                                  shard_ids=config.SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,21 +28,49 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+@bot.event
+async def setup_hook():
+    # Alerts are DMed through the bot's HTTP client, which is only usable once the bot has logged in.
+    db.start_background_task(deliver_budget_alerts(bot))
+
+
 @bot.event
 async def on_ready():
     logger.info(f"{bot.user.name} is online!")
-    await bot.tree.sync()
+    # Commands are global, so a single process syncs them.
+    if not config.SHARD_IDS or 0 in config.SHARD_IDS:
+        await bot.tree.sync()
 
 
 async def setup():
     await db.connect()
     await db.create_tables()
+    # Start from the local currency snapshot; only a cold start with an empty snapshot waits for the API.
+    if await db.load_valid_currencies():
+        db.start_background_task(db.refresh_valid_currencies())
+    else:
+        await db.refresh_valid_currencies()
+    db.start_background_task(db.refresh_valid_currencies_periodically())
+    await db.load_location_index()
+    if config.CACHE_SYNC:
+        db.start_background_task(db.listen_for_invalidations())
+    db.start_background_task(db.refresh_exchange_rates_periodically())
+    await expense_writer.recover()
+    if config.SPENT_WRITE_BEHIND:
+        db.start_background_task(expense_writer.run())
     await setup_commands(bot)
 
 
 async def main():
     await setup()
-    await bot.start(config.BOT_TOKEN)
+    try:
+        await bot.start(config.BOT_TOKEN)
+    finally:
+        # Flush queued expenses while the db is still open.
+        await expense_writer.close()
+        await db.close()
+        if config.TRACE_STATS_FILE:
+            dump_traces(config.TRACE_STATS_FILE)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from utils.exchange_rates import ExchangeRateProvider
+
+
+class StubRateApi:
+    """Serves /latest/<base> with the rates in `rates`, counting requests; `release` gates slow responses."""
+
+    def __init__(self):
+        self.rates = {"ILS": 3.7}
+        self.requests = 0
+        self.release = asyncio.Event()
+        self.release.set()
+        app = web.Application()
+        app.router.add_get("/latest/{base}", self.latest)
+        self.server = TestServer(app)
+
+    async def latest(self, request):
+        self.requests += 1
+        await self.release.wait()
+        return web.json_response({"conversion_rates": dict(self.rates)})
+
+    def provider(self, **kwargs):
+        return ExchangeRateProvider(base_url=str(self.server.make_url("")), **kwargs)
+
+
+def run_with_api(test):
+    async def run():
+        api = StubRateApi()
+        await api.server.start_server()
+        try:
+            await test(api)
+        finally:
+            await api.server.close()
+
+    asyncio.run(run())
+
+
+def test_concurrent_lookups_share_one_fetch():
+    async def test(api):
+        provider = api.provider(ttl=60)
+        api.release.clear()
+        lookups = asyncio.gather(*(provider.get_rate("usd", "ILS") for _ in range(10)))
+        await asyncio.sleep(0.05)
+        api.release.set()
+        assert await lookups == [3.7] * 10
+        assert api.requests == 1
+        await provider.close()
+
+    run_with_api(test)
+
+
+def test_rates_are_cached_until_the_ttl_expires():
+    async def test(api):
+        provider = api.provider(ttl=0.1)
+        await provider.get_rates("USD")
+        await provider.get_rates("USD")
+        assert api.requests == 1
+        await asyncio.sleep(0.15)
+        await provider.get_rates("USD")
+        assert api.requests == 2
+        await provider.close()
+
+    run_with_api(test)
+
+
+def test_stale_rates_are_served_while_refreshing():
+    async def test(api):
+        provider = api.provider(ttl=0.3, stale_timeout=0.05)
+        assert await provider.get_rate("USD", "ILS") == 3.7
+        await asyncio.sleep(0.35)
+
+        # The refresh is stuck upstream, so the expired table is served without waiting for it.
+        api.rates = {"ILS": 3.9}
+        api.release.clear()
+        assert await provider.get_rate("USD", "ILS") == 3.7
+        assert await provider.get_rate("USD", "ILS") == 3.7
+        assert api.requests == 2
+
+        # Once the refresh completes, its rates are served.
+        api.release.set()
+        await asyncio.sleep(0.02)
+        assert await provider.get_rate("USD", "ILS") == 3.9
+        assert api.requests == 2
+        await provider.close()
+
+    run_with_api(test)
@@ -0,0 +1,42 @@
+import asyncio
+import os
+
+import asyncpg
+import pytest
+
+from db.database import Database
+from db.statements import Connection
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+
+def test_run_counts_statement_cache_hits():
+    async def run():
+        database = Database()
+        conn = await asyncpg.connect(TEST_DATABASE_URL, connection_class=Connection)
+        try:
+            await conn.execute("CREATE TEMP TABLE user_locations (user_id TEXT PRIMARY KEY, location TEXT NOT NULL)")
+            await database._run(conn, "fetchval", "get_location", "1")
+            await database._run(conn, "fetchval", "get_location", "1")
+        finally:
+            await conn.close()
+        return database.statement_stats
+
+    assert asyncio.run(run()) == {"hits": 1, "misses": 1}
+
+
+def test_run_counts_evicted_statements_as_misses():
+    async def run():
+        database = Database()
+        conn = await asyncpg.connect(TEST_DATABASE_URL, connection_class=Connection, statement_cache_size=0)
+        try:
+            await conn.execute("CREATE TEMP TABLE user_locations (user_id TEXT PRIMARY KEY, location TEXT NOT NULL)")
+            await database._run(conn, "fetchval", "get_location", "1")
+            await database._run(conn, "fetchval", "get_location", "1")
+        finally:
+            await conn.close()
+        return database.statement_stats
+
+    assert asyncio.run(run()) == {"hits": 0, "misses": 2}
@@ -1,2 +1,30 @@
+import re
+from datetime import datetime, timezone
+
+
+def utc_now():
+    """The current time as stored in expenses.timestamp: UTC, without a time zone."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 def format_time(dt):
     return dt.strftime("%H:%m %d/%m/%Y")
+
+
+def period_bounds(period):
+    """
+    Returns the [start, end) datetimes covered by a specific year (e.g., "2025") or month/year (e.g., "05/25")
+    filter, or None if the value is not a valid period.
+    """
+    if re.match(r"^\d{4}$", period):
+        year = int(period)
+        if year < 1 or year > 9998:
+            return None
+        return datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    if re.match(r"^\d{2}/\d{2}$", period):
+        month, year = (int(part) for part in period.split("/"))
+        if not 1 <= month <= 12:
+            return None
+        year += 2000
+        return datetime(year, month, 1), datetime(year + month // 12, month % 12 + 1, 1)
+    return None
@@ -1,6 +1,30 @@
 import os
 
 BOT_TOKEN = os.environ.get("DISCORD_BOT_TOKEN")
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+SHARD_IDS = [int(shard_id) for shard_id in os.environ["SHARD_IDS"].split(",")] if os.environ.get("SHARD_IDS") else None
+CACHE_SYNC = os.environ.get("CACHE_SYNC", "").lower() in ("1", "true", "yes")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 10))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 100))
+DB_COMMAND_TIMEOUT = float(os.environ["DB_COMMAND_TIMEOUT"]) if os.environ.get("DB_COMMAND_TIMEOUT") else None
+DB_ACQUIRE_TIMEOUT = float(os.environ["DB_ACQUIRE_TIMEOUT"]) if os.environ.get("DB_ACQUIRE_TIMEOUT") else None
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.environ.get("DB_MAX_INACTIVE_CONNECTION_LIFETIME", 300))
 EXCHANGE_API_KEY = os.environ.get("EXCHANGE_API_KEY")
+EXCHANGE_API_BASE_URL = os.environ.get("EXCHANGE_API_BASE_URL",
+                                       f"https://v6.exchangerate-api.com/v6/{EXCHANGE_API_KEY}").rstrip("/")
+RATE_CACHE_TTL = float(os.environ.get("RATE_CACHE_TTL", 3600))
+RATE_STALE_TIMEOUT = float(os.environ.get("RATE_STALE_TIMEOUT", 2))
+RATE_HISTORY_REFRESH_INTERVAL = float(os.environ.get("RATE_HISTORY_REFRESH_INTERVAL", 6 * 60 * 60))
+CURRENCY_REFRESH_INTERVAL = float(os.environ.get("CURRENCY_REFRESH_INTERVAL", 24 * 60 * 60))
+SPENT_WRITE_BEHIND = os.environ.get("SPENT_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+SPENT_QUEUE_SIZE = int(os.environ.get("SPENT_QUEUE_SIZE", 1000))
+SPENT_BATCH_SIZE = int(os.environ.get("SPENT_BATCH_SIZE", 100))
+SPENT_SPOOL_FILE = os.environ.get("SPENT_SPOOL_FILE", "spent_spool.jsonl")
+CHART_CACHE_SIZE = int(os.environ.get("CHART_CACHE_SIZE", 256))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 600))
+TRACE_SLOW_THRESHOLD = float(os.environ.get("TRACE_SLOW_THRESHOLD", 2))
+TRACE_STATS_FILE = os.environ.get("TRACE_STATS_FILE")
 ALLOWED_IDS = {int(uid.strip()) for uid in os.environ.get("ALLOWED_IDS", "").split(",") if uid.strip().isdigit()}
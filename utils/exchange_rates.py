@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+import numpy as np
+
+from utils import config
+
+logger = logging.getLogger(__name__)
+
+
+class ExchangeRateProvider:
+    """
+    Async, in-memory cache of exchange rate tables, keyed by base currency.
+    Concurrent misses for the same base currency share a single in-flight fetch, and once a table
+    has expired the stale copy is served if the refresh takes longer than `stale_timeout` seconds.
+    """
+
+    def __init__(self, base_url: str = None, ttl: float = None, stale_timeout: float = None):
+        self.base_url = (base_url or config.EXCHANGE_API_BASE_URL).rstrip("/")
+        self.ttl = config.RATE_CACHE_TTL if ttl is None else ttl
+        self.stale_timeout = config.RATE_STALE_TIMEOUT if stale_timeout is None else stale_timeout
+        self._session = None
+        self._cache = {}
+        self._inflight = {}
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _fetch_rates(self, base_currency: str) -> dict:
+        session = await self._get_session()
+        async with session.get(f"{self.base_url}/latest/{base_currency}") as response:
+            response.raise_for_status()
+            data = await response.json()
+        rates = data["conversion_rates"]
+        self._cache[base_currency] = (time.monotonic(), rates)
+        return rates
+
+    def _on_fetch_done(self, base_currency: str, task: asyncio.Task):
+        self._inflight.pop(base_currency, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Failed to refresh {base_currency} rates: {task.exception()!r}")
+
+    def _refresh(self, base_currency: str) -> asyncio.Task:
+        task = self._inflight.get(base_currency)
+        if task is None:
+            task = asyncio.create_task(self._fetch_rates(base_currency))
+            task.add_done_callback(lambda t: self._on_fetch_done(base_currency, t))
+            self._inflight[base_currency] = task
+        return task
+
+    async def get_rates(self, base_currency: str) -> dict:
+        base_currency = base_currency.upper()
+        cached = self._cache.get(base_currency)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+
+        task = self._refresh(base_currency)
+        if not cached:
+            return await asyncio.shield(task)
+
+        # Stale-while-revalidate: give the refresh a short window, otherwise serve the expired table.
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.stale_timeout)
+        except (asyncio.TimeoutError, aiohttp.ClientError, KeyError, ValueError):
+            logger.info(f"Serving stale {base_currency} rates while refreshing")
+            return cached[1]
+
+    async def get_supported_codes(self) -> list:
+        """Fetch the [code, name] pairs of every currency supported by the API (not cached)."""
+        session = await self._get_session()
+        async with session.get(f"{self.base_url}/codes") as response:
+            response.raise_for_status()
+            data = await response.json()
+        return data.get("supported_codes", [])
+
+    async def get_rate(self, from_currency: str, to_currency: str) -> float:
+        rates = await self.get_rates(from_currency)
+        return rates.get(to_currency.upper(), 1.0)
+
+
+class CrossRates:
+    """
+    The exchange rate between every pair of currencies, as a matrix built from a single rate table (units of each
+    currency per one unit of the table's base currency): matrix[i, j] is the rate from codes[i] to codes[j].
+    """
+
+    def __init__(self, base_currency: str, base_rates: dict):
+        base_rates = {code: float(rate) for code, rate in base_rates.items() if rate and float(rate) > 0}
+        base_rates[base_currency] = 1.0
+        self.codes = list(base_rates)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        rates = np.fromiter(base_rates.values(), dtype=np.float64, count=len(base_rates))
+        self.matrix = rates[np.newaxis, :] / rates[:, np.newaxis]
+
+    def rate(self, from_currency: str, to_currency: str) -> float:
+        return float(self.matrix[self.index[from_currency], self.index[to_currency]])
+
+    def factors(self, currencies, to_currency: str) -> np.ndarray:
+        """The rate from each of `currencies` to `to_currency`; raises KeyError for an unknown currency."""
+        return self.matrix[[self.index[currency] for currency in currencies], self.index[to_currency]]
+
+
+rate_provider = ExchangeRateProvider()
@@ -0,0 +1,76 @@
+import io
+from collections import OrderedDict
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from utils.expense_stats import ExpenseStats
+
+CHART_GROUPINGS = ("month", "location")
+# Keep charts readable: the latest months, or the locations with the highest totals.
+MAX_BARS = 36
+
+
+def render_chart(stats: ExpenseStats, group_by: str, currency: str = "ILS") -> bytes:
+    """
+    Render a user's spending per month or per location as a PNG bar chart. Only the object-oriented Figure API is
+    used (not pyplot's global state), so charts can be rendered concurrently in worker threads.
+    """
+    groups = stats.group_totals(group_by)
+    if group_by == "location":
+        groups = sorted(groups, key=lambda group: group[1], reverse=True)[:MAX_BARS]
+    else:
+        groups = groups[-MAX_BARS:]
+    labels = [label for label, *_ in groups]
+    totals = [total for _, total, *_ in groups]
+
+    figure = Figure(figsize=(max(6.0, len(labels) * 0.4), 4.0), dpi=100, layout="tight")
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.bar(labels, totals, color="#5865F2")
+    axes.set_title(f"Spending per {group_by}")
+    axes.set_ylabel(currency)
+    axes.tick_params(axis="x", labelrotation=45)
+    axes.grid(axis="y", alpha=0.3)
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+class ChartCache:
+    """
+    Rendered charts keyed by (user, query, data version), holding only the latest data version of each user, so a
+    change to the user's expenses invalidates all of their charts at once. The least recently used users are evicted
+    beyond `max_users`.
+    """
+
+    def __init__(self, max_users: int = 256):
+        self.max_users = max_users
+        self._charts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, query, version):
+        version_charts = self._charts.get(str(user_id))
+        chart = version_charts[1].get(query) if version_charts and version_charts[0] == version else None
+        if chart is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._charts.move_to_end(str(user_id))
+        return chart
+
+    def put(self, user_id, query, version, chart: bytes):
+        version_charts = self._charts.get(str(user_id))
+        if version_charts and version_charts[0] > version:
+            # The expenses changed while this chart was rendering.
+            return
+        if not version_charts or version_charts[0] < version:
+            version_charts = self._charts[str(user_id)] = (version, {})
+        version_charts[1][query] = chart
+        self._charts.move_to_end(str(user_id))
+        while len(self._charts) > self.max_users:
+            self._charts.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._charts.pop(str(user_id), None)
@@ -0,0 +1,32 @@
+import asyncio
+import csv
+import gzip
+import io
+
+# The import columns come first, so an exported file can be imported back with /import_expenses.
+EXPORT_COLUMNS = ("amount", "currency", "description", "location", "timestamp", "converted_amount", "id")
+
+
+def _format_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+async def export_expenses_csv(batches, fileobj):
+    """
+    Writes batches of expense records to fileobj as gzip-compressed CSV and returns the number of rows written.
+    Only one batch is held in memory at a time, and compression runs in a worker thread to keep the event loop free.
+    """
+    exported = 0
+    with gzip.GzipFile(filename="expenses.csv", fileobj=fileobj, mode="wb") as archive:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        async for batch in batches:
+            writer.writerows([_format_value(row[column]) for column in EXPORT_COLUMNS] for row in batch)
+            await asyncio.to_thread(archive.write, buffer.getvalue().encode())
+            buffer.seek(0)
+            buffer.truncate()
+            exported += len(batch)
+        if buffer.tell():
+            await asyncio.to_thread(archive.write, buffer.getvalue().encode())
+    return exported
@@ -0,0 +1,90 @@
+import csv
+import io
+import json
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+
+from utils.common_funcs import utc_now
+
+IMPORT_COLUMNS = ("amount", "currency", "description", "location", "timestamp")
+# Amounts are stored as NUMERIC(10, 2).
+MAX_AMOUNT = Decimal("1e8")
+
+
+class ImportRowError(ValueError):
+    def __init__(self, line_number, message):
+        super().__init__(f"Row {line_number}: {message}")
+        self.line_number = line_number
+
+
+def iter_import_rows(filename: str, data: bytes):
+    """
+    Yields (line_number, row) pairs from a CSV (with a header row), JSON Lines or JSON array file, where row maps
+    column names to raw values. CSV and JSON Lines files are parsed lazily, one line at a time.
+    """
+    name = filename.lower()
+    if name.endswith(".json"):
+        rows = json.loads(data)
+        if not isinstance(rows, list):
+            raise ValueError("A JSON file must contain a list of expenses.")
+        yield from enumerate(rows, start=1)
+    elif name.endswith(".jsonl"):
+        for line_number, line in enumerate(io.StringIO(data.decode("utf-8-sig")), start=1):
+            if line.strip():
+                yield line_number, json.loads(line)
+    elif name.endswith(".csv"):
+        reader = csv.DictReader(io.StringIO(data.decode("utf-8-sig"), newline=""))
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        raise ValueError("Unsupported file type, use .csv, .json or .jsonl.")
+
+
+def parse_timestamp(value):
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+    for parse in (datetime.fromisoformat, lambda v: datetime.strptime(v, "%d/%m/%Y")):
+        try:
+            return parse(value).replace(tzinfo=None)
+        except ValueError:
+            continue
+    raise ValueError(value)
+
+
+def parse_import_row(line_number, row, valid_currencies, default_location=None, default_timestamp=None):
+    """Validates a raw import row and returns its (amount, currency, description, location, timestamp)."""
+    if not isinstance(row, dict):
+        raise ImportRowError(line_number, "expected an object with " + ", ".join(IMPORT_COLUMNS))
+    row = {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+
+    try:
+        amount = Decimal(str(row.get("amount", "")).strip())
+    except InvalidOperation:
+        raise ImportRowError(line_number, f"invalid amount '{row.get('amount')}'") from None
+    if not amount.is_finite():
+        raise ImportRowError(line_number, f"invalid amount '{row.get('amount')}'")
+    if abs(amount) >= MAX_AMOUNT:
+        raise ImportRowError(line_number, f"amount '{amount}' is too large")
+
+    currency = str(row.get("currency") or "").strip().upper()
+    if currency not in valid_currencies:
+        raise ImportRowError(line_number, f"invalid currency '{currency}'")
+
+    description = str(row.get("description") or "").strip()
+    if not description:
+        raise ImportRowError(line_number, "missing description")
+
+    location = str(row.get("location") or "").strip().lower() or default_location
+    if not location:
+        raise ImportRowError(line_number, "missing location and no current location is set")
+
+    timestamp = row.get("timestamp")
+    if timestamp in (None, ""):
+        timestamp = default_timestamp or utc_now()
+    else:
+        try:
+            timestamp = parse_timestamp(timestamp.strip() if isinstance(timestamp, str) else timestamp)
+        except (ValueError, TypeError, OverflowError, OSError):
+            raise ImportRowError(line_number, f"invalid timestamp '{timestamp}'") from None
+
+    return amount, currency, description, location, timestamp
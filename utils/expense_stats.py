@@ -0,0 +1,130 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+from utils.common_funcs import period_bounds
+
+EPOCH = date(1970, 1, 1)
+STATS_GROUPINGS = ("year", "month", "week", "location", "currency")
+
+
+def to_epoch_day(day: date) -> int:
+    return (day - EPOCH).days
+
+
+def from_epoch_day(day) -> date:
+    return EPOCH + timedelta(days=int(day))
+
+
+class ExpenseStats:
+    """
+    A user's spending held as NumPy columns, one entry per (day, location, currency) with the total converted
+    amount, total original amount and number of expenses, sorted by day. Every statistic is a vectorized pass over
+    these columns, so it stays fast however many expenses the user has.
+    """
+
+    def __init__(self, days, location_codes, locations, currency_codes, currencies, amounts, original_amounts, counts):
+        self.days = days
+        self.location_codes = location_codes
+        self.locations = locations
+        self.currency_codes = currency_codes
+        self.currencies = currencies
+        self.amounts = amounts
+        self.original_amounts = original_amounts
+        self.counts = counts
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build from (day, location, currency, amount, original_amount, count) rows sorted by day."""
+        size = len(rows)
+        days = np.fromiter((to_epoch_day(row[0]) for row in rows), dtype=np.int32, count=size)
+        locations, location_codes = np.unique(np.array([row[1] for row in rows], dtype=object), return_inverse=True)
+        currencies, currency_codes = np.unique(np.array([row[2] for row in rows], dtype=object), return_inverse=True)
+        amounts = np.fromiter((row[3] for row in rows), dtype=np.float64, count=size)
+        original_amounts = np.fromiter((row[4] for row in rows), dtype=np.float64, count=size)
+        counts = np.fromiter((row[5] for row in rows), dtype=np.int64, count=size)
+        return cls(days, location_codes, list(locations), currency_codes, list(currencies), amounts, original_amounts,
+                   counts)
+
+    def in_currency(self, factors):
+        """The same stats with each amount converted from its original currency by `factors` (one per currency)."""
+        amounts = self.original_amounts * np.asarray(factors, dtype=np.float64)[self.currency_codes]
+        return ExpenseStats(self.days, self.location_codes, self.locations, self.currency_codes, self.currencies,
+                            amounts, self.original_amounts, self.counts)
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def total(self) -> float:
+        return float(self.amounts.sum())
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def _group_codes(self, group_by):
+        """Per-entry group codes and the label of each code, for one of STATS_GROUPINGS."""
+        if group_by == "location":
+            return self.location_codes, self.locations
+        if group_by == "currency":
+            return self.currency_codes, self.currencies
+        if group_by == "week":
+            # Epoch day 0 was a Thursday; weeks start on Monday.
+            keys = self.days - (self.days + 3) % 7
+            unique, codes = np.unique(keys, return_inverse=True)
+            return codes, [from_epoch_day(day).strftime("%d/%m/%y") for day in unique]
+        unit, label_format = {"year": ("Y", "%Y"), "month": ("M", "%m/%y")}[group_by]
+        keys = self.days.astype("datetime64[D]").astype(f"datetime64[{unit}]")
+        unique, codes = np.unique(keys, return_inverse=True)
+        return codes, [day.astype("datetime64[D]").item().strftime(label_format) for day in unique]
+
+    def group_totals(self, group_by):
+        """(label, total, count, original total) per group, in chronological/alphabetical order."""
+        codes, labels = self._group_codes(group_by)
+        totals = np.bincount(codes, weights=self.amounts, minlength=len(labels))
+        counts = np.bincount(codes, weights=self.counts, minlength=len(labels))
+        original_totals = np.bincount(codes, weights=self.original_amounts, minlength=len(labels))
+        return [(label, float(total), int(count), float(original_total))
+                for label, total, count, original_total in zip(labels, totals, counts, original_totals)]
+
+    def daily_totals(self, start_day: int, end_day: int):
+        """Total spent on every day in [start_day, end_day)."""
+        lo, hi = np.searchsorted(self.days, [start_day, end_day])
+        return np.bincount(self.days[lo:hi] - start_day, weights=self.amounts[lo:hi], minlength=end_day - start_day)
+
+    def running_average(self, window: int, today: int) -> float:
+        """Average daily spend over the `window` days up to and including `today`."""
+        return float(self.daily_totals(today - window + 1, today + 1).sum()) / window
+
+    def burn_rate(self, budget: float, period: str, today: date):
+        """
+        Spending within `period` (a year or mm/yy) against `budget`: returns a dict with the amount spent so far,
+        the days elapsed/left, the daily burn rate, the projected period total and, if the budget runs out before the
+        period ends at that rate, the day it does.
+        """
+        start, end = (to_epoch_day(bound.date()) for bound in period_bounds(period))
+        today_day = min(max(to_epoch_day(today), start), end - 1)
+        elapsed = today_day - start + 1
+        daily = self.daily_totals(start, end)
+        spent = float(daily[:elapsed].sum())
+        rate = spent / elapsed
+        days_left = end - today_day - 1
+        exhausted_on = None
+        if rate > 0 and spent < budget:
+            runs_out = today_day + int(np.ceil((budget - spent) / rate))
+            if runs_out < end:
+                exhausted_on = from_epoch_day(runs_out)
+        elif spent >= budget:
+            # The first day the cumulative spend reached the budget.
+            exhausted_on = from_epoch_day(start + int(np.searchsorted(np.cumsum(daily[:elapsed]), budget)))
+        return {
+            "spent": spent,
+            "remaining": budget - spent,
+            "days_elapsed": elapsed,
+            "days_left": days_left,
+            "daily_rate": rate,
+            "daily_allowance": (budget - spent) / days_left if days_left else 0.0,
+            "projected": spent + rate * days_left,
+            "exhausted_on": exhausted_on,
+        }
@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import time
+import traceback
+from collections import defaultdict, deque
+
+from utils import config
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyStats:
+    """
+    Call count, error count, latency (in seconds) and, for operations traced with sized=True, result size; percentiles
+    cover the latest `window` calls.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=window)
+        self.sized = 0
+        self.total_size = 0
+        self.max_size = 0
+
+    def record(self, elapsed: float, error: bool = False, size: int = None):
+        self.count += 1
+        self.errors += error
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.samples.append(elapsed)
+        if size is not None:
+            self.sized += 1
+            self.total_size += size
+            self.max_size = max(self.max_size, size)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "average_ms": self.average * 1000,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+            "average_size": self.total_size / self.sized if self.sized else None,
+            "max_size": self.max_size if self.sized else None,
+        }
+
+    def summary(self) -> str:
+        text = (f"{self.count} calls, p50 {self.percentile(50) * 1000:.1f} ms, p95 {self.percentile(95) * 1000:.1f} ms, "
+                f"p99 {self.percentile(99) * 1000:.1f} ms, max {self.max * 1000:.1f} ms, {self.errors} errors")
+        if self.sized:
+            text += f", avg size {self.total_size / self.sized:.0f}"
+        return text
+
+
+# Stats of every traced function, keyed by trace name.
+traces = defaultdict(LatencyStats)
+
+
+def _result_size(result):
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+
+def _await_chain_frames(task):
+    """The frames of every coroutine/generator the task is currently awaiting, outermost first."""
+    frames, awaitable = [], task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None) or \
+            getattr(awaitable, "gi_frame", None)
+        if frame is not None:
+            frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None) or \
+            getattr(awaitable, "gi_yieldfrom", None)
+    return frames
+
+
+def _log_slow_call(name, task, threshold):
+    """Sample where a call that is still running after `threshold` seconds is waiting."""
+    stack = traceback.StackSummary.extract((frame, frame.f_lineno) for frame in _await_chain_frames(task))
+    logger.warning(f"{name} is taking longer than {threshold}s, currently at:\n{''.join(stack.format())}")
+
+
+def traced(name: str, sized: bool = False):
+    """
+    Record the latency and errors of every call of the decorated coroutine or async generator function under `name`,
+    and with `sized` its result size: the len() of the result (e.g. rows fetched), or the total size of the items an
+    async generator yields. Only db calls are sized, as commands reply through Discord rather than returning their
+    response. Calls running longer than TRACE_SLOW_THRESHOLD have their stack logged.
+    """
+
+    def decorator(func):
+        def start_slow_call_timer():
+            if not config.TRACE_SLOW_THRESHOLD:
+                return None
+            return asyncio.get_running_loop().call_later(config.TRACE_SLOW_THRESHOLD, _log_slow_call, name,
+                                                         asyncio.current_task(), config.TRACE_SLOW_THRESHOLD)
+
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start, size, error = time.perf_counter(), 0 if sized else None, True
+                timer = start_slow_call_timer()
+                try:
+                    async for item in func(*args, **kwargs):
+                        if sized:
+                            size += _result_size(item) or 1
+                        yield item
+                    error = False
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                    traces[name].record(time.perf_counter() - start, error, size)
+        else:
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start, size, error = time.perf_counter(), None, True
+                timer = start_slow_call_timer()
+                try:
+                    result = await func(*args, **kwargs)
+                    size, error = _result_size(result) if sized else None, False
+                    return result
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                    traces[name].record(time.perf_counter() - start, error, size)
+
+        return wrapper
+
+    return decorator
+
+
+def traced_methods(prefix: str, exclude=()):
+    """
+    Class decorator applying `traced` (with sized=True) to every public coroutine and async generator method not in
+    `exclude`.
+    """
+
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith("_") or attr in exclude:
+                continue
+            if inspect.iscoroutinefunction(value) or inspect.isasyncgenfunction(value):
+                setattr(cls, attr, traced(f"{prefix}.{attr}", sized=True)(value))
+        return cls
+
+    return decorator
+
+
+def dump_traces(path: str):
+    """Write the stats of every traced function to `path` as JSON."""
+    with open(path, "w") as file:
+        json.dump({name: stats.to_dict() for name, stats in sorted(traces.items())}, file, indent=2)
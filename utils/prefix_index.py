@@ -0,0 +1,31 @@
+from bisect import bisect_left, insort
+
+
+class PrefixIndex:
+    """
+    Case-insensitive prefix search over a set of strings, kept as a sorted list of (lowercase key, value) pairs:
+    a lookup is a binary search to the first match followed by a scan of the matches only.
+    """
+
+    def __init__(self, values=()):
+        self._entries = sorted({(value.lower(), value) for value in values})
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, value: str):
+        entry = (value.lower(), value)
+        i = bisect_left(self._entries, entry)
+        if i == len(self._entries) or self._entries[i] != entry:
+            insort(self._entries, entry, lo=i)
+
+    def search(self, prefix: str, limit: int = 25) -> list:
+        """Up to `limit` values starting with `prefix` (ignoring case), in alphabetical order."""
+        prefix = prefix.lower()
+        matches = []
+        for i in range(bisect_left(self._entries, (prefix,)), len(self._entries)):
+            key, value = self._entries[i]
+            if not key.startswith(prefix) or len(matches) == limit:
+                break
+            matches.append(value)
+        return matches
@@ -0,0 +1,74 @@
+import sys
+import time
+from collections import OrderedDict
+
+from utils import config
+
+
+class ResponseCache:
+    """
+    LRU cache of rendered command responses, bounded by entry count and by age (`ttl` seconds). Every entry records
+    the data version of its user it was rendered from, so a response is served only while that version is current.
+    """
+
+    def __init__(self, max_entries: int = None, ttl: float = None):
+        self.max_entries = config.RESPONSE_CACHE_SIZE if max_entries is None else max_entries
+        self.ttl = config.RESPONSE_CACHE_TTL if ttl is None else ttl
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size_of(value) -> int:
+        if isinstance(value, tuple):
+            return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+        return sys.getsizeof(value)
+
+    def _pop(self, key):
+        _, _, _, size = self._entries.pop(key)
+        self.size -= size
+
+    def get(self, key, version):
+        """The response cached for `key` at data version `version`, or None."""
+        entry = self._entries.get(key)
+        if entry is not None and (entry[0] != version or entry[1] < time.monotonic()):
+            self._pop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def put(self, key, version, value):
+        if self.max_entries <= 0:
+            return
+        if key in self._entries:
+            if self._entries[key][0] > version:
+                # The user's data changed while this response was rendering.
+                return
+            self._pop(key)
+        size = self._size_of(value)
+        self._entries[key] = (version, time.monotonic() + self.ttl, value, size)
+        self.size += size
+        while len(self._entries) > self.max_entries:
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+response_cache = ResponseCache()
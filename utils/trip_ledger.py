@@ -0,0 +1,38 @@
+import heapq
+from decimal import Decimal
+
+CENT = Decimal("0.01")
+
+
+def split_evenly(total: Decimal, participants) -> dict:
+    """
+    Split `total` between `participants` in whole cents; the cents that don't divide evenly go to the first ones,
+    so the shares always add up to `total`.
+    """
+    participants = list(participants)
+    cents = int((total / CENT).to_integral_value())
+    share, remainder = divmod(cents, len(participants))
+    return {participant: (share + (i < remainder)) * CENT for i, participant in enumerate(participants)}
+
+
+def settle_up(balances: dict) -> list:
+    """
+    Transfers (debtor, creditor, amount) that bring every member's net balance (positive if they are owed money) to
+    zero. Greedily matching the largest debt with the largest credit takes at most members - 1 transfers, in
+    O(members log members).
+    """
+    debtors = [(balance, member) for member, balance in balances.items() if balance < 0]
+    creditors = [(-balance, member) for member, balance in balances.items() if balance > 0]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+    transfers = []
+    while debtors and creditors:
+        debt, debtor = heapq.heappop(debtors)
+        credit, creditor = heapq.heappop(creditors)
+        amount = min(-debt, -credit)
+        transfers.append((debtor, creditor, amount))
+        if debt + amount < 0:
+            heapq.heappush(debtors, (debt + amount, debtor))
+        if credit + amount < 0:
+            heapq.heappush(creditors, (credit + amount, creditor))
+    return transfers
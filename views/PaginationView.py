@@ -0,0 +1,55 @@
+import discord
+
+
+class PaginationView(discord.ui.View):
+    """
+    Previous/next navigation over lazily fetched pages.
+    `fetch_page(cursor)` returns the page content and the cursor of the page after it (None on the last page);
+    the cursor of the first page is None.
+    """
+
+    def __init__(self, user_id: int, fetch_page, next_cursor, timeout: float = 180.0):
+        super().__init__(timeout=timeout)
+        self.user_id = user_id
+        self.fetch_page = fetch_page
+        self.page_cursors = [None]
+        self.page_index = 0
+        self.next_cursor = next_cursor
+        self.message = None
+        self._update_buttons()
+
+    def _update_buttons(self):
+        self.previous.disabled = self.page_index == 0
+        self.page.label = f"Page {self.page_index + 1}"
+        self.next.disabled = self.next_cursor is None
+
+    async def _show_page(self, interaction: discord.Interaction):
+        content, self.next_cursor = await self.fetch_page(self.page_cursors[self.page_index])
+        self._update_buttons()
+        await interaction.response.edit_message(content=content, view=self)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.user_id
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page_index -= 1
+        await self._show_page(interaction)
+
+    @discord.ui.button(label="Page 1", style=discord.ButtonStyle.secondary, disabled=True)
+    async def page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.primary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        del self.page_cursors[self.page_index + 1:]
+        self.page_cursors.append(self.next_cursor)
+        self.page_index += 1
+        await self._show_page(interaction)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass